@@ -0,0 +1,115 @@
+"""Resolves many redirects and invite codes at once from one event loop.
+
+Used by the audit and to prefetch a listing for the scan loop. Every
+redirect and invite code is resolved at most once, each code is fetched as
+soon as a redirect reveals it, and all requests share one aiohttp session.
+Requires aiohttp.
+"""
+
+import asyncio
+import logging
+
+import discord
+import links
+import redirects
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+def _is_redirect(url):
+    return links.classify(url)[0] == links.REDIRECT
+
+async def resolve_all(redirect_urls, codes, bucket, concurrency, max_attempts):
+    """Follows the redirects and fetches the invites concurrently.
+
+    Args:
+        redirect_urls: Iterable of redirector urls to follow
+        codes: Iterable of invite codes to fetch
+        bucket: The ratelimit.TokenBucket for discord requests
+        concurrency: The maximum requests in flight at once
+        max_attempts: How many times to try each redirect or code
+
+    Returns:
+        A tuple of two dicts. The first maps each redirect url to a tuple
+        (resolved, final_url) and the second maps each invite code, including
+        those found by following the redirects, to a tuple (resolved, invite).
+        resolved is False when we never got a definitive answer. invite is
+        None for invites that do not exist.
+    """
+    if aiohttp is None:
+        raise ModuleNotFoundError('aiohttp is required for async requests')
+
+    semaphore = asyncio.Semaphore(concurrency)
+    invite_tasks = {}
+
+    async with aiohttp.ClientSession() as session:
+        async def fetch_invite(code):
+            for tries in range(1, max_attempts + 1):
+                try:
+                    async with semaphore:
+                        succ, transient, invite = await discord.get_invite_from_code_async(code, session, bucket)
+                except asyncio.CancelledError:
+                    # An Exception before python 3.8
+                    raise
+                except Exception as e:
+                    logger.warning('Error fetching invite %s: %s', code, e)
+                    await asyncio.sleep(tries)
+                    continue
+                if succ or not transient:
+                    return True, invite
+                await asyncio.sleep(tries)
+            return False, None
+
+        def invite_task(code):
+            if code not in invite_tasks:
+                invite_tasks[code] = asyncio.ensure_future(fetch_invite(code))
+            return invite_tasks[code]
+
+        async def follow(url):
+            for tries in range(1, max_attempts + 1):
+                try:
+                    async with semaphore:
+                        final_url = await redirects.follow_async(url, _is_redirect, session=session)
+                except redirects.RedirectError as re:
+                    logger.warning('%s following %s', re, re.url)
+                    await asyncio.sleep(tries)
+                    continue
+                except asyncio.CancelledError:
+                    # An Exception before python 3.8
+                    raise
+                except Exception as e:
+                    logger.warning('Error following %s: %s', url, e)
+                    await asyncio.sleep(tries)
+                    continue
+
+                kind, code = links.classify(final_url)
+                if kind == links.OFFICIAL and code is not None:
+                    invite_task(code)
+                return True, final_url
+            return False, None
+
+        for code in codes:
+            invite_task(code)
+
+        redirect_urls = list(redirect_urls)
+        try:
+            redirect_results = await asyncio.gather(*(follow(url) for url in redirect_urls))
+            invite_results = await asyncio.gather(*invite_tasks.values())
+        finally:
+            for task in invite_tasks.values():
+                task.cancel()
+
+    return dict(zip(redirect_urls, redirect_results)), dict(zip(invite_tasks.keys(), invite_results))
+
+def run(redirect_urls, codes, bucket, concurrency, max_attempts):
+    """Runs resolve_all on a new event loop. See resolve_all."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(resolve_all(redirect_urls, codes, bucket, concurrency, max_attempts))
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3.6
+
+"""Revalidates every advert we are tracking.
+
+Streams every advert from the database, resolves each distinct redirect
+and invite code once, concurrently and within the discord request budget,
+and reports the posts whose invites have died or now lead to a different
+server. With --queue those posts are handed to the scan loop, which
+handles them again on its next pass.
+
+With --async the redirects and codes are resolved from one event loop
+instead of a thread pool, which allows hundreds of requests in flight.
+
+Usage:
+    python3 audit.py [--queue] [--async] [--workers N] [--rate R]
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aioresolve
+import concurrency
+import config
+import database
+import discord
+import links
+import log
+import redirects
+import retry
+from ratelimit import SharedTokenBucket
+
+DEAD = 'dead'
+"""Finding for an advert whose invite no longer works"""
+
+CHANGED = 'changed'
+"""Finding for an advert whose invite now leads to a different server"""
+
+def _retry_sleep(tries, *args, **kwargs):
+    time.sleep(tries)
+
+def resolve_redirect(url, max_attempts):
+    """Follows the redirector url to its final url.
+
+    Args:
+        url: The string url of the redirector
+        max_attempts: How many times to try before giving up
+
+    Returns:
+        A tuple of two values. The first is a bool that is True if we reached
+        the end of the redirects. The second is the final string url, or None
+        if we could not reach it.
+    """
+    def try_follow():
+        return True, redirects.follow(url, lambda u: links.classify(u)[0] == links.REDIRECT)
+
+    try:
+        return True, retry.until_success(try_follow, failure_fn=_retry_sleep, max_attempts=max_attempts)
+    except retry.RetryError:
+        return False, None
+
+def resolve_code(code, bucket, max_attempts):
+    """Fetches the invite for the code, staying within the bucket's budget.
+
+    Args:
+        code: The string invite code
+        bucket: The ratelimit.TokenBucket for discord requests
+        max_attempts: How many times to try before giving up
+
+    Returns:
+        A tuple of two values. The first is a bool that is True if we got a
+        definitive answer from discord. The second is the invite object, or
+        None if the invite does not exist or we could not get an answer.
+    """
+    def try_get_invite():
+        succ, transient, invite = discord.get_invite_from_code(code, bucket)
+        if succ or not transient:
+            return True, invite
+        return False, None
+
+    try:
+        return True, retry.until_success(try_get_invite, failure_fn=_retry_sleep, max_attempts=max_attempts)
+    except retry.RetryError:
+        return False, None
+
+def _resolve_threaded(redirect_urls, codes, bucket, workers, max_attempts):
+    """Resolves the redirects, then the codes, on a thread pool.
+
+    Returns:
+        The same as aioresolve.resolve_all
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        redirect_results = dict(zip(redirect_urls,
+            executor.map(lambda url: resolve_redirect(url, max_attempts), redirect_urls)))
+
+        codes = set(codes)
+        for resolved, final_url in redirect_results.values():
+            kind, code = links.classify(final_url)
+            if resolved and kind == links.OFFICIAL and code is not None:
+                codes.add(code)
+
+        codes = list(codes)
+        invite_results = dict(zip(codes,
+            executor.map(lambda code: resolve_code(code, bucket, max_attempts), codes)))
+
+    return redirect_results, invite_results
+
+def audit(workers, rate, max_attempts, use_async=False):
+    """Revalidates every advert in the database.
+
+    Args:
+        workers: How many redirects or invite codes to resolve at once
+        rate: The discord requests per second to stay within, together
+            with every other process on the host
+        max_attempts: How many times to try each redirect or code
+        use_async: True to resolve from an event loop with aioresolve,
+            False to use a thread pool
+
+    Returns:
+        A tuple of two values. The first is a list of (finding, advert, code,
+        invite) tuples, where finding is DEAD or CHANGED, advert is the dict
+        from database.iter_adverts_with_groups, code is the invite code (None
+        if the link had none) and invite is the fetched invite object or None.
+        The second is a dict of counts for the summary.
+    """
+    counts = { 'adverts': 0, 'skipped': 0, 'redirects': 0, 'codes': 0, 'unresolved': 0 }
+    findings = []
+    by_redirect = {}
+    by_code = {}
+
+    for advert in database.iter_adverts_with_groups():
+        counts['adverts'] += 1
+        kind, code = links.classify(advert['link'])
+        if kind == links.REDIRECT:
+            by_redirect.setdefault(advert['link'], []).append(advert)
+        elif kind == links.OFFICIAL and code is not None:
+            by_code.setdefault(code, []).append(advert)
+        elif kind == links.OFFICIAL:
+            findings.append((DEAD, advert, None, None))
+        else:
+            counts['skipped'] += 1
+
+    counts['redirects'] = len(by_redirect)
+    bucket = SharedTokenBucket(config.ratelimit_file, 'discord', rate,
+        config.discord_bucket_capacity, config.discord_reserve_tokens['audit'])
+    urls = list(by_redirect.keys())
+    codes = list(by_code.keys())
+    if use_async:
+        redirect_results, invite_results = aioresolve.run(urls, codes, bucket, workers, max_attempts)
+    else:
+        redirect_results, invite_results = _resolve_threaded(urls, codes, bucket, workers, max_attempts)
+    bucket.close()
+
+    for url, (resolved, final_url) in redirect_results.items():
+        if not resolved:
+            counts['unresolved'] += len(by_redirect[url])
+            continue
+        kind, code = links.classify(final_url)
+        if kind != links.OFFICIAL or code is None:
+            findings.extend((DEAD, advert, None, None) for advert in by_redirect[url])
+            continue
+        by_code.setdefault(code, []).extend(by_redirect[url])
+
+    counts['codes'] = len(by_code)
+    for code, adverts in by_code.items():
+        resolved, invite = invite_results[code]
+        if not resolved:
+            counts['unresolved'] += len(adverts)
+            continue
+        for advert in adverts:
+            if invite is None:
+                findings.append((DEAD, advert, code, None))
+            elif str(invite['guild']['id']) != str(advert['dgroup_id']):
+                findings.append((CHANGED, advert, code, invite))
+
+    findings.sort(key=lambda finding: (str(finding[1]['dgroup_id']), finding[1]['posted_at']))
+    return findings, counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Revalidate every advert we are tracking')
+    parser.add_argument('--queue', action='store_true', help='queue the failing posts for the scan loop to handle')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='resolve from one event loop (requires aiohttp)')
+    parser.add_argument('--workers', type=int, default=config.audit_workers, help='most redirects or codes to resolve at once; each host is limited further as it responds')
+    parser.add_argument('--rate', type=float, default=config.discord_requests_per_second, help='discord requests per second')
+    parser.add_argument('--attempts', type=int, default=config.audit_max_attempts, help='attempts per redirect or code')
+    args = parser.parse_args()
+
+    # The report is printed; logging is for the lookups along the way
+    log.setup()
+
+    print('Connecting to database')
+    database.connect(config.database_file)
+    database.create_missing_tables()
+
+    started_at = time.time()
+    findings, counts = audit(args.workers, args.rate, args.attempts, args.use_async)
+    elapsed = time.time() - started_at
+
+    last_dgroup_id = None
+    for finding, advert, code, invite in findings:
+        if advert['dgroup_id'] != last_dgroup_id:
+            last_dgroup_id = advert['dgroup_id']
+            print(f'Server {last_dgroup_id}:')
+        if finding == CHANGED:
+            print(f'  {finding} {advert["fullname"]} {advert["permalink"]} code {code} now goes to {invite["guild"]["id"]}')
+        else:
+            print(f'  {finding} {advert["fullname"]} {advert["permalink"]} code {code}')
+
+        if args.queue:
+            # committed together by the writer, and waited for by close
+            database.expire_advert(advert['id'], wait=False)
+            database.save_pending(advert['fullname'], f'audit: {finding}', wait=False)
+
+    print(f'Audited {counts["adverts"]} adverts ({counts["redirects"]} redirects, {counts["codes"]} codes) in {round(elapsed)} seconds')
+    print(f'  {len(findings)} failing, {counts["unresolved"]} unresolved, {counts["skipped"]} without a known link')
+    if args.queue:
+        print(f'  Queued {len(findings)} posts for the scan loop')
+    for host, state in sorted(concurrency.limits().items()):
+        print(f'  {host} ended with {state["limit"]} requests at once, {state["latency"] or 0:.2f}s each')
+
+    database.close()
+
+if __name__ == '__main__':
+    main()
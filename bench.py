@@ -0,0 +1,272 @@
+#!/usr/bin/env python3.6
+
+"""Benchmarks the functions on the bot's hot path.
+
+Runs offline: nothing here talks to reddit or discord, and the database
+benchmarks use a scratch database filled with generated adverts at each of
+the given sizes. Every benchmark reports the best time per call over a few
+runs.
+
+With --save the results are written as a json baseline. With --compare the
+results are checked against a saved baseline, and the script exits with
+status 1 if any benchmark got slower by more than the threshold, so a change
+to the hot path can be shown to help (or at least not hurt) at our sizes.
+
+Usage:
+    python3 bench.py [--sizes 1000,100000,1000000] [--only TEXT]
+        [--save FILE] [--compare FILE] [--threshold 0.2]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+import database
+import links
+import log
+from stringlist import StringList
+
+try:
+    import redirects
+except ModuleNotFoundError:
+    redirects = None
+
+def measure(fn, repeat=5, min_seconds=0.05):
+    """Times fn, calling it enough times per run to get a stable result.
+
+    Args:
+        fn: The function to time, called without arguments
+        repeat: How many runs to take the best of
+        min_seconds: How long each run should take at least
+
+    Returns:
+        The best seconds per call
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_seconds:
+            break
+        number *= 10 if elapsed < min_seconds / 10 else 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        best = min(best, timer.timeit(number) / number)
+    return best
+
+def bench_links():
+    urls = [
+        'https://discord.gg/abcDEF',
+        'https://www.discordapp.com/invite/abcDEF',
+        'https://discord.plus/some-server',
+        'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    ]
+    for url in urls:
+        yield f'links.classify {url}', lambda url=url: links.classify(url)
+    listing = [random.choice(urls) for _ in range(1000)]
+    yield 'links.classify_many 1000 urls', lambda: links.classify_many(listing)
+
+def bench_printable():
+    name = '✨ Ｆａｎｃｙ Ｓｅｒｖｅｒ ✨ | Gaming • Anime • Memes 🎮 Z̷̢a̸l̶g̵o̴ '
+    yield 'log.printable short unicode name', lambda: log.printable(name)
+    long_name = name * 20
+    yield 'log.printable long unicode name', lambda: log.printable(long_name)
+
+def bench_stringlist(directory):
+    for size in (10000, 100000):
+        path = os.path.join(directory, f'stringlist_{size}.txt')
+        with open(path, 'w') as out:
+            for id in range(size):
+                out.write(f'{100000000000000000 + id},a comment\n')
+        strings = StringList(path)
+        strings.fetch()
+        present = str(100000000000000000 + size - 1)
+        yield f'StringList.fetch membership present {size}', lambda strings=strings, id=present: id in strings.fetch()
+        yield f'StringList.fetch membership absent {size}', lambda strings=strings: '1' in strings.fetch()
+
+def bench_find_redirect():
+    if redirects is None:
+        print('Skipping find_redirect; requests or bs4 is not installed')
+        return
+
+    body = ''.join(f'<div class="server"><p>Server {i}</p><a href="/s/{i}">join</a></div>' for i in range(5000))
+    with_meta = f'<html><head><title>x</title></head><body>{body}<meta http-equiv="refresh" content="0; url=https://discord.gg/abc"></body></html>'
+    without_meta = f'<html><head><title>x</title></head><body>{body}</body></html>'
+    yield 'redirects.find_redirect large page with meta refresh', \
+        lambda: redirects._find_redirect('https://discord.plus/x', 200, {}, with_meta)
+    yield 'redirects.find_redirect large page without redirect', \
+        lambda: redirects._find_redirect('https://discord.plus/x', 200, {}, without_meta)
+
+def _group_count(size):
+    """How many groups the database of size adverts has"""
+    return max(size // 10, 1)
+
+def _fill_database(file, size):
+    """Creates a database of size adverts, posted just now so prune keeps them"""
+    database.connect(file)
+    database.create_missing_tables()
+    database.close()
+
+    now = time.time()
+    groups = _group_count(size)
+    connection = sqlite3.connect(file)
+    connection.executemany('INSERT INTO groups (id, dgroup_name, created_at) VALUES (?, ?, ?)',
+        ((100000000000000000 + id, f'Server {id}', now) for id in range(groups)))
+    connection.executemany('INSERT INTO adverts (id, group_id, found_at, updated_at, posted_at, link, ns) VALUES (?, ?, ?, ?, ?, ?, 0)',
+        ((id, 100000000000000000 + id % groups, now, now, now, f'https://discord.gg/{id}') for id in range(size)))
+    connection.executemany('INSERT INTO pending (id, reason, queued_at) VALUES (?, ?, ?)',
+        ((id, 'bench', now) for id in range(0, size, max(size // 100, 1))))
+    connection.commit()
+    connection.close()
+
+def bench_database(directory, size, only):
+    # Filling the database is slow at the larger sizes, so only fill it when
+    # one of its benchmarks will run
+    benchmarks = [(name, fn) for name, fn in _database_benchmarks(size) if only is None or only in name]
+    if not benchmarks:
+        return
+
+    file = os.path.join(directory, f'bench_{size}.db')
+    _fill_database(file, size)
+    database.connect(file)
+    try:
+        yield from benchmarks
+    finally:
+        database.close()
+        os.remove(file)
+
+def _database_benchmarks(size):
+    fullname = f't3_{database.id36_from_id(size // 2)}'
+    group_id = 100000000000000000 + _group_count(size) // 2
+
+    yield f'database.fetch_group_by_id {size}', lambda: database.fetch_group_by_id(group_id)
+    yield f'database.fetch_group_by_dgroup_id {size}', lambda: database.fetch_group_by_dgroup_id(str(group_id))
+    yield f'database.fetch_advert_by_fullname {size}', lambda: database.fetch_advert_by_fullname(fullname)
+    yield f'database.fetch_adverts_by_group_id {size}', lambda: database.fetch_adverts_by_group_id(group_id)
+    yield f'database.fetch_pending {size}', database.fetch_pending
+    yield f'database.fetch_state {size}', database.fetch_state
+    yield f'database.holds_lease {size}', lambda: database.holds_lease('submission:bench', 'bench')
+    yield f'database.iter_adverts_with_groups {size}', lambda: sum(1 for _ in database.iter_adverts_with_groups())
+
+    new_ids = iter(range(size, size * 1000))
+    saved = []
+    def save_advert():
+        id = next(new_ids)
+        saved.append(id)
+        database.save_advert(f't3_{database.id36_from_id(id)}', None, group_id, time.time())
+    yield f'database.save_advert {size}', save_advert
+
+    def delete_advert():
+        database.delete_advert(saved.pop() if saved else 0)
+    yield f'database.delete_advert {size}', delete_advert
+
+    new_groups = iter(range(1, size * 1000))
+    yield f'database.save_group {size}', lambda: database.save_group('Bench', str(next(new_groups)))
+    yield f'database.touch_advert {size}', lambda: database.touch_advert(size // 2)
+    yield f'database.touch_advert queued {size}', lambda: database.touch_advert(size // 2, wait=False)
+    yield f'database.expire_advert {size}', lambda: database.expire_advert(size // 2)
+    yield f'database.save_pending {size}', lambda: database.save_pending(fullname, 'bench')
+    yield f'database.delete_pending {size}', lambda: database.delete_pending(fullname)
+    yield f'database.save_state {size}', lambda: database.save_state({'bench': [1, 2, 3]})
+    yield f'database.claim_lease {size}', lambda: database.claim_lease('submission:bench', 'bench', 60)
+    yield f'database.release_lease {size}', lambda: database.release_lease('submission:bench', 'bench')
+    yield f'database.refresh_partitions {size}', lambda: database.refresh_partitions('bench', 64, 60)
+    yield f'database.prune {size}', database.prune
+
+def run(sizes, only):
+    """Runs every benchmark whose name contains only.
+
+    Args:
+        sizes: The advert counts to run the database benchmarks at
+        only: Text the benchmark names must contain, or None for all
+
+    Returns:
+        A dict of benchmark name to the best seconds per call
+    """
+    results = {}
+    directory = tempfile.mkdtemp(prefix='bench')
+    try:
+        groups = [bench_links(), bench_printable(), bench_stringlist(directory), bench_find_redirect()]
+        groups += [bench_database(directory, size, only) for size in sizes]
+        for group in groups:
+            for name, fn in group:
+                if only is not None and only not in name:
+                    continue
+                results[name] = measure(fn)
+                print(f'{name:<64} {_format_seconds(results[name]):>10}')
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def _format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f}{unit}'
+    return f'{seconds / 1e-9:.0f}ns'
+
+def compare(results, baseline, threshold):
+    """Prints how the results compare to the baseline.
+
+    Args:
+        results: The dict returned by run
+        baseline: A dict returned by run earlier
+        threshold: The fraction a benchmark may get slower by, ie 0.2
+
+    Returns:
+        A list of the names of the benchmarks that got slower by more than
+        the threshold
+    """
+    regressions = []
+    print()
+    print(f'{"benchmark":<64} {"baseline":>10} {"now":>10} {"change":>8}')
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSED'
+        print(f'{name:<64} {_format_seconds(baseline[name]):>10} {_format_seconds(seconds):>10} {change:>+8.0%}{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the functions on the hot path')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated advert counts for the database benchmarks, empty for none')
+    parser.add_argument('--only', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a json baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='how much slower than the baseline counts as a regression')
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = run([int(size) for size in args.sizes.split(',') if size], args.only)
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'created_at': time.time(),
+                'results': results,
+            }, out, indent=2)
+        print(f'Saved the results to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
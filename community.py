@@ -0,0 +1,124 @@
+"""The subreddits the bot moderates.
+
+Each entry of config.subreddits describes one subreddit. Any setting an
+entry leaves out is taken from the module level value of the same name in
+config.py, so a single subreddit setup needs nothing more than its name.
+"""
+
+import config
+from modfeed import ModFeed
+from stringlist import StringList
+
+SETTINGS = (
+    'response_message',
+    'too_soon_response_message',
+    'double_post_response_message',
+    'flair_id',
+    'modmail_recipient',
+    'post_update_time_seconds',
+    'min_time_between_posts_seconds',
+    'max_posts_until_miss_in_new',
+    'num_hot_posts_to_rescan',
+    'loops_per_hot_check',
+)
+"""The settings an entry in config.subreddits may override"""
+
+class Community:
+    """One subreddit we moderate, its settings and its scan state.
+
+    Attributes:
+        name: The name of the subreddit, without r/
+        namespace: The int that separates this subreddit's adverts from
+            those of the other subreddits in the database
+        subreddit: The praw.models.Subreddit
+        blacklist: StringList of banned discord server ids
+        whitelist: StringList of authors whose posts we ignore
+        recently_checked_subm_ids: The ids in new we already handled
+        hot_check_counter: Loops left until the next hot scan
+        hot_done_ids: The ids the running hot scan already handled, None
+            when no hot scan is running
+        feed: The modfeed.ModFeed following the subreddit's moderators
+
+    Every name in SETTINGS is an attribute as well.
+    """
+
+    def __init__(self, reddit, settings, index=0):
+        """Creates the community for an entry of config.subreddits.
+
+        Args:
+            reddit: The praw.Reddit instance shared by every community
+            settings: The dict from config.subreddits
+            index: The position of the entry in config.subreddits, which is
+                the namespace unless the entry sets one
+        """
+        self.name = settings['name']
+        self.namespace = settings.get('namespace', index)
+        for setting in SETTINGS:
+            setattr(self, setting, settings.get(setting, getattr(config, setting)))
+        self.subreddit = reddit.subreddit(self.name)
+        self.blacklist = StringList(settings.get('blacklist_file', 'blacklist.txt'))
+        self.whitelist = StringList(settings.get('whitelist_file', 'whitelist.txt'))
+
+        self.recently_checked_subm_ids = []
+        self.hot_check_counter = 0
+        self.hot_done_ids = None
+        self.feed = ModFeed(self.subreddit)
+
+    def save_state(self):
+        """Returns the scan state as a json serializable dict"""
+        return {
+            'recently_checked_subm_ids': self.recently_checked_subm_ids,
+            'hot_check_counter': self.hot_check_counter,
+            'hot_done_ids': self.hot_done_ids,
+        }
+
+    def restore_state(self, state):
+        """Restores the scan state returned by save_state
+
+        Args:
+            state: The dict returned by save_state
+        """
+        self.recently_checked_subm_ids = state.get('recently_checked_subm_ids', [])
+        self.hot_check_counter = state.get('hot_check_counter', 0)
+        self.hot_done_ids = state.get('hot_done_ids')
+
+def load(reddit):
+    """Creates a community for every entry in config.subreddits
+
+    Args:
+        reddit: The praw.Reddit instance to share between them
+
+    Returns:
+        A list of Community, in the order of config.subreddits
+
+    Raises:
+        ValueError: If two entries end up with the same namespace
+    """
+    communities = [Community(reddit, settings, index) for index, settings in enumerate(config.subreddits)]
+    names_by_namespace = {}
+    for comm in communities:
+        if comm.namespace in names_by_namespace:
+            raise ValueError(f'r/{comm.name} and r/{names_by_namespace[comm.namespace]} share namespace {comm.namespace}')
+        names_by_namespace[comm.namespace] = comm.name
+    return communities
+
+def interleave(listings):
+    """Takes one item from each listing in turn until all are exhausted
+
+    This is how the scan loop shares its time fairly between subreddits.
+
+    Args:
+        listings: A list of lists
+
+    Yields:
+        The items of the listings, round robin
+    """
+    iterators = [iter(listing) for listing in listings]
+    while iterators:
+        remaining = []
+        for iterator in iterators:
+            for item in iterator:
+                yield item
+                remaining.append(iterator)
+                break
+        iterators = remaining
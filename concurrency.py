@@ -0,0 +1,279 @@
+"""Tunes how many requests may be in flight to each host.
+
+Every host gets a limit that starts at config.concurrency_initial_limit and
+is adjusted as its responses come back, AIMD style: while the host answers
+at its usual latency and we are using the whole limit, the limit grows by
+about one per limit's worth of responses. When the host times out or
+ratelimits us the limit is halved, and when its latency climbs past
+config.concurrency_latency_tolerance times its baseline it is cut by a
+tenth. A fast redirector ends up with many requests in flight and a slow
+one with few, without tuning either by hand.
+"""
+
+import asyncio
+import collections
+import contextlib
+import math
+import threading
+import time
+from urllib.parse import urlsplit
+
+import config
+
+SUCCESS = 'success'
+"""Outcome of a request that was answered"""
+
+OVERLOADED = 'overloaded'
+"""Outcome of a request that timed out or was ratelimited"""
+
+FAILED = 'failed'
+"""Outcome of a request that failed for another reason, which says nothing
+about how loaded the host is"""
+
+class Slot:
+    """A request in flight, see Limiter.slot.
+
+    Attributes:
+        outcome: SUCCESS, OVERLOADED or FAILED. Starts as SUCCESS, and
+            becomes FAILED if the request raises without setting it.
+    """
+
+    def __init__(self):
+        self.outcome = SUCCESS
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class Limiter:
+    """The adaptive concurrency limit of one host. Thread-safe.
+
+    Threads wait with acquire and event loops with acquire_async; both may
+    use the same limiter.
+
+    Attributes:
+        host: The host name the limit is for
+        limit: The current limit, a float. floor(limit) requests may be in
+            flight at once.
+        min_limit: The limit is never cut below this
+        max_limit: The limit never grows above this
+        tolerance: How many times the baseline latency counts as overloaded
+        in_flight: The number of requests in flight
+        latency: The smoothed seconds per successful request, None until
+            the first
+        baseline: The seconds a successful request takes when the host is
+            not loaded. Follows the fastest responses, drifting up slowly
+            so that it recovers if the host gets slower for good.
+        decreased_at: The monotonic time the limit was last cut
+    """
+
+    def __init__(self, host, initial, min_limit, max_limit, tolerance):
+        """Creates the limiter with nothing in flight.
+
+        Args:
+            host: The host name
+            initial: The limit to start at
+            min_limit: The lowest limit, at least 1
+            max_limit: The highest limit
+            tolerance: How many times the baseline latency counts as
+                overloaded
+        """
+        self.host = host
+        self.limit = float(initial)
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self.decreased_at = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.async_waiters = collections.deque()
+
+    def _has_room(self):
+        return self.in_flight < math.floor(self.limit)
+
+    def acquire(self):
+        """Waits until a request may be sent, then counts it as in flight."""
+        with self.condition:
+            while not self._has_room():
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        """Yields to the event loop until a request may be sent, then counts
+        it as in flight."""
+        loop = asyncio.get_event_loop()
+        while True:
+            with self.lock:
+                if self._has_room():
+                    self.in_flight += 1
+                    return
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # We may have been woken for a slot; let someone else have it
+                with self.lock:
+                    self._wake_waiters()
+                raise
+
+    def _wake_waiters(self):
+        self.condition.notify_all()
+        while self.async_waiters:
+            loop, future = self.async_waiters.popleft()
+            loop.call_soon_threadsafe(_wake, future)
+
+    def _decrease(self, factor, now):
+        # Requests sent before the last cut report the load from before it,
+        # so only cut once per round trip
+        if now - self.decreased_at < (self.latency or 0):
+            return
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.decreased_at = now
+
+    def release(self, latency, outcome):
+        """Counts a request as finished and adjusts the limit from its outcome.
+
+        Args:
+            latency: How many seconds the request took
+            outcome: SUCCESS, OVERLOADED or FAILED
+        """
+        with self.lock:
+            was_full = not self._has_room()
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == SUCCESS:
+                self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += (latency - self.baseline) * 0.01
+                if latency > self.baseline * self.tolerance:
+                    self._decrease(0.9, now)
+                elif was_full:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif outcome == OVERLOADED:
+                self._decrease(0.5, now)
+            self._wake_waiters()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Holds a slot for the duration of a with block, timing the request.
+
+        Set the outcome on the yielded Slot when the request times out or is
+        ratelimited.
+
+        Yields:
+            The Slot of the request
+        """
+        self.acquire()
+        slot = Slot()
+        started_at = time.monotonic()
+        try:
+            yield slot
+        except BaseException:
+            if slot.outcome == SUCCESS:
+                slot.outcome = FAILED
+            raise
+        finally:
+            self.release(time.monotonic() - started_at, slot.outcome)
+
+    def slot_async(self):
+        """The same as slot, for use with async with."""
+        return _AsyncSlot(self)
+
+    def describe(self):
+        """Returns the state of the limiter as a json serializable dict"""
+        with self.lock:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'latency': self.latency,
+                'baseline': self.baseline,
+            }
+
+class _AsyncSlot:
+    """The async context manager returned by Limiter.slot_async.
+
+    A class rather than contextlib.asynccontextmanager, which needs
+    python 3.7.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.slot = None
+        self.started_at = None
+
+    async def __aenter__(self):
+        await self.limiter.acquire_async()
+        self.slot = Slot()
+        self.started_at = time.monotonic()
+        return self.slot
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.slot.outcome == SUCCESS:
+            self.slot.outcome = FAILED
+        self.limiter.release(time.monotonic() - self.started_at, self.slot.outcome)
+        return False
+
+class Controller:
+    """The limiters of every host we send requests to. Thread-safe.
+
+    Attributes:
+        limiters: dict of host name to its Limiter
+    """
+
+    def __init__(self, initial, min_limit, max_limit, tolerance):
+        """Creates a controller that has no limiters yet.
+
+        Args:
+            initial: The limit each host starts at
+            min_limit: The lowest limit of any host
+            max_limit: The highest limit of any host
+            tolerance: How many times a host's baseline latency counts as
+                overloaded
+        """
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, url):
+        """Finds the limiter for the host of the url, creating it if needed.
+
+        Args:
+            url: The string url about to be requested
+
+        Returns:
+            The Limiter of the url's host
+        """
+        host = (urlsplit(url).hostname or '').lower()
+        with self.lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limiter = Limiter(host, self.initial, self.min_limit, self.max_limit, self.tolerance)
+                self.limiters[host] = limiter
+            return limiter
+
+    def limits(self):
+        """Returns a dict of host name to the Limiter.describe of its limiter"""
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return dict((limiter.host, limiter.describe()) for limiter in limiters)
+
+controller = Controller(config.concurrency_initial_limit, config.concurrency_min_limit,
+    config.concurrency_max_limit, config.concurrency_latency_tolerance)
+"""The controller built from config, shared by every module"""
+
+def limiter_for(url):
+    """The Limiter for the url's host, see Controller.limiter"""
+    return controller.limiter(url)
+
+def limits():
+    """The current limits of every host, see Controller.limits"""
+    return controller.limits()
@@ -2,6 +2,19 @@ import os
 
 subreddit_name = 'DiscordServers'
 
+# The subreddits to moderate from this one process. They share the reddit
+# login, the request budget and the invite / redirect lookups. Each entry
+# needs a name, and may set:
+#   namespace: an int, different for every subreddit, that keeps their
+#       adverts apart in the database. Defaults to the entry's position in
+#       this list; set it before reordering the list.
+#   blacklist_file / whitelist_file: defaults to blacklist.txt / whitelist.txt
+#   any of the settings listed in community.SETTINGS, which otherwise
+#       default to the values of the same name in this file
+subreddits = [
+    { 'name': subreddit_name },
+]
+
 response_message = '''Your invite link has expired at r/DiscordServers.
 
 This means either you did not generate a permanent invite link or you have likely closed the server.
@@ -37,31 +50,31 @@ If you are certain this bot has made a mistake, and not due to reddit's time est
 Sincerely,
 The r/DiscordServers Team'''
 
+# PACING
+# The bot spends reddit's request budget (reddit.auth.limits) evenly over
+# each ratelimit window, so the waits below are bounds rather than fixed
+# sleeps. The upper bounds are also used until reddit has reported our
+# limits. When the budget runs out the bot waits for the window to reset.
+loop_min_sleep_seconds = 60
 loop_sleep_time_seconds = 60 * 10
-#check_sleep_time_seconds = 5
+check_min_sleep_seconds = 1
 check_sleep_time_seconds = 30
+# requests left unspent in every window as a safety margin
+pacing_reserve_requests = 30
 loops_per_hot_check = 10
 flair_id = '3c0343d0-3daa-11e6-b5ea-0e43c84e73c3'
+# who modmail about blacklisted or changed servers is sent to
+modmail_recipient = 'SubredditGuardian'
 
 # how many of the most recent posts do we check every loop?
 # this number needs to bigger than your peak posts per loop.
-# a loop worst case about:
+# a loop worst case, with every wait at its upper bound, is about:
 # (loop_sleep_time_seconds
 #   + check_sleep_time_seconds * max_posts_until_miss_in_new) +
 # (loop_sleep_time_seconds
 #   + check_sleep_time_seconds * num_hot_posts_to_rescan)
-# seconds.
+# seconds. pacing shortens it whenever reddit leaves us headroom.
 #
-# if
-#loop_sleep_time_seconds = 30
-#check_sleep_time_seconds = 5
-#loops_per_hot_check = 10
-#max_posts_until_miss_in_new = 10
-#num_hot_posts_to_rescan = 100
-# then
-# (30 + 5 * 10) + (30 + 5 * 100) = 80 + 530 = 610 seconds/slowest loop
-# (610 seconds / slowest loop) * (1 loop / 10 posts) = 61 seconds/post
-# at peak
 # max 1000
 max_posts_until_miss_in_new = 50
 
@@ -75,9 +88,136 @@ post_update_time_seconds = 60 * 60
 
 min_time_between_posts_seconds = 60 * 60 * 24
 
+# MOD FEEDS
+# Every loop the bot reads each subreddit's mod log and unmoderated queue.
+# Submissions a moderator already removed or approved are left out of the
+# scans, and submissions reported since we last checked them are rechecked
+# before anything else.
+modfeed_enabled = True
+# the most mod log entries / unmoderated submissions read every loop
+modfeed_log_limit = 100
+modfeed_unmoderated_limit = 100
+# how long we remember that a moderator handled a submission; longer than
+# submissions stay in hot
+modfeed_resolved_ttl_seconds = 60 * 60 * 24 * 3
+
+# LINK CLASSIFICATION
+# Hosts that serve discord invites directly, mapped to the paths that may
+# come before the invite code. Subdomains (www., ptb., canary.) are accepted.
+official_hosts = {
+    'discord.gg': ['', 'invite/'],
+    'discord.com': ['invite/'],
+    'discordapp.com': ['invite/'],
+}
+
+# Hosts we trust to redirect to a discord invite
+redirector_hosts = [
+    'discord.plus',
+    'discord.link',
+    'invite.gg',
+    'discord.st',
+]
+
+# How long the result of an invite or redirect lookup is shared with later
+# posts using the same code or redirector url
+coalesce_ttl_seconds = 60 * 10
+
+# ADAPTIVE CONCURRENCY
+# How many requests may be in flight to one host (a redirector, discord) at
+# once is tuned for each host while running: it grows while the host
+# answers at its usual speed and is cut when the host times out, ratelimits
+# us or slows down.
+concurrency_initial_limit = 4
+concurrency_min_limit = 1
+concurrency_max_limit = 64
+# how many times slower than usual a host may answer before it counts as
+# overloaded
+concurrency_latency_tolerance = 2.0
+
 # DATABASE RELATED STUFF
 database_file = os.path.join(os.path.dirname(__file__), 'discordservers.db')
 database_prune_period_seconds = 60 * 60
 
+# SHARED RATE LIMITS
+# Every process on this host that uses the same discord token (the bot, a
+# dry run instance, the audit) shares one discord request budget through
+# this file, and backs off together when discord ratelimits any of them.
+ratelimit_file = os.path.join(os.path.dirname(__file__), 'ratelimits.db')
+# the discord request budget, across all of those processes
+discord_requests_per_second = 2
+# how many discord requests may be made at once after a quiet spell
+discord_bucket_capacity = 10
+# discord requests each kind of process leaves unspent in the budget, so
+# that only the processes with less reserve may make them. The scan takes
+# precedence over everything else. Less than discord_bucket_capacity.
+discord_reserve_tokens = {
+    'scan': 0,
+    'shadow': 5,
+    'audit': 5,
+}
+# reddit requests each kind of process leaves unspent in every window, on
+# top of pacing_reserve_requests. reddit counts the requests of every
+# process logged in to the same account together, so the pacing of each
+# already sees what the others spend.
+reddit_reserve_requests = {
+    'scan': 0,
+    'shadow': 200,
+}
+
+# AUDIT RELATED STUFF
+# how many invite codes / redirects the audit resolves at once
+audit_workers = 16
+# how many times the audit tries a code or redirect before giving up on it
+audit_max_attempts = 3
+
+# ASYNC
+# Resolve the redirects and invites of each listing from one event loop
+# before handling its posts, so handling them only waits on reddit.
+# Requires aiohttp.
+async_prefetch = False
+# the maximum redirect / invite requests in flight at once
+async_concurrency = 100
+
+# WORKERS
+# With --workers N the bot runs N worker processes that split the
+# submissions between them by id. Workers can also be added while running
+# with --worker NAME.
+# how many partitions the submissions are split into; more than the most
+# workers you will run
+worker_partitions = 64
+# how long a worker's claim on its partitions lasts without being renewed,
+# which is how long it takes the others to take over from a crashed worker.
+# It must be longer than the longest wait in the scan loop.
+worker_lease_seconds = loop_sleep_time_seconds * 2
+# how long a worker's claim on a submission lasts while handling it. A
+# worker that takes longer than this does not act on the submission.
+submission_lease_seconds = 60 * 10
+
+# LOGGING
+# Records are written from a background thread, so a slow stdout or disk
+# does not hold up the scan.
+# the lowest level logged: DEBUG, INFO, WARNING or ERROR
+log_level = 'INFO'
+# 'text', or 'json' for one json object per line
+log_format = 'text'
+# the file to log to, or None for stdout. The file is rotated once it
+# reaches log_max_bytes, keeping log_backup_count old files.
+log_file = None
+log_max_bytes = 1024 * 1024 * 10
+log_backup_count = 5
+
+# WATCHDOG
+# A thread watches the scan loop. When the loop makes no progress for
+# watchdog_stall_seconds, or handling one submission takes longer than
+# submission_deadline_seconds, it logs the stack of every thread. A
+# submission past its deadline is then abandoned and the scan moves on.
+# The stall time must be longer than the longest wait in the scan loop.
+watchdog_stall_seconds = loop_sleep_time_seconds * 3
+# less than submission_lease_seconds, so a worker never acts on a
+# submission it no longer holds
+submission_deadline_seconds = 60 * 5
+# how long the scan keeps retrying one redirect or invite lookup
+lookup_timeout_seconds = 60 * 3
+
 # MISC
 dry_run = False
@@ -1,60 +1,373 @@
 """Module for interacting with the sqlite database
 
+The tables store discord and reddit ids as integers rather than text; the
+functions in this module convert them back, so every fetch returns the same
+dictionaries as before the schema was compacted.
+
 Tables:
     groups:
         Maps discord groups to an internal representation
 
-        id: (int, autoincrement, primary)
+        id: (int, primary) the discord snowflake of the group. Returned as
+            both id (int) and dgroup_id (text)
         dgroup_name: (text)
-        dgroup_id: (text, unique)
         created_at: (real) unix time
 
     adverts:
         Maps submissions to the subreddit to the group they advertised
 
-        id: (int, autoincrement, primary)
-        fullname: (text, unique)
-        permalink: (text)
-        group_id: (int, foreign key references groups(id))
+        id: (int, primary) the base 36 reddit id of the submission as an int.
+            fullname (text, ie t3_asdf) and permalink (text) are derived
+            from it.
+        group_id: (int, references groups(id))
+        ns: (int) the namespace of the subreddit the submission is in
         found_at: (real) unix time
         updated_at: (real) unix time
         posted_at: (real) unix time
+        link: (text) the url the submission linked to, None for adverts
+            saved before we tracked it
+
+    pending:
+        Submissions queued to be handled again by the scan loop, for example
+        by an audit
+
+        id: (int, primary) the submission id as in adverts. Returned as
+            fullname (text)
+        reason: (text)
+        queued_at: (real) unix time
+
+    state:
+        Checkpoint of the scan loop, so that a restart picks up where it
+        left off
+
+        key: (text, primary)
+        value: (text) json encoded
+
+    leases:
+        Claims that worker processes hold on shared work, so that two
+        workers never handle the same thing at once
+
+        item: (text, primary) what is claimed, ie partition:3
+        owner: (text) the worker holding the claim
+        expires_at: (real) unix time the claim lapses unless renewed
+
+Threads:
+    Every function may be called from any thread. Writes are queued to a
+    single writer thread, which commits whatever has queued up together in
+    one transaction; the functions that write take wait=True and, given
+    wait=False, return a concurrent.futures.Future instead of waiting for
+    the commit. Reads use a read only connection of the calling thread's
+    own, which in WAL mode never waits for the writer.
 """
 
+from concurrent.futures import Future
+import json
+import logging
+import math
+import queue
 import sqlite3
+import threading
 import time
 
-connection = None
+SCHEMA_VERSION = 2
+"""The version of the schema create_missing_tables migrates to, stored in
+sqlite's user_version. 0 is the original schema with text ids, 1 has
+integer ids and 2 adds namespaces to adverts."""
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+logger = logging.getLogger(__name__)
+
+def id_from_fullname(fullname):
+    """Converts a reddit fullname or id to the int we store
+
+    Args:
+        fullname: the reddit fullname (ie t3_asdf) or just the id (ie asdf)
+
+    Returns:
+        The base 36 id as an int
+    """
+    if fullname[2:3] == '_':
+        fullname = fullname[3:]
+    return int(fullname, 36)
+
+def id36_from_id(id):
+    """Converts the int we store back to the base 36 reddit id
+
+    Args:
+        id: the int id
+
+    Returns:
+        The reddit id, ie asdf
+    """
+    digits = []
+    while True:
+        id, digit = divmod(id, 36)
+        digits.append(_BASE36[digit])
+        if id == 0:
+            return ''.join(reversed(digits))
+
+def _group_dict(row):
+    if row is None:
+        return None
+    res = dict(row)
+    res['dgroup_id'] = str(res['id'])
+    return res
+
+def _advert_dict(row):
+    if row is None:
+        return None
+    res = dict(row)
+    id36 = id36_from_id(res['id'])
+    res['fullname'] = f't3_{id36}'
+    res['permalink'] = f'/comments/{id36}/'
+    if 'dgroup_name' in res:
+        res['dgroup_id'] = str(res['group_id'])
+    return res
+
+class _Writer(threading.Thread):
+    """The thread that owns the connection every write goes through.
+
+    Writes are queued as functions of a cursor. The writer takes whatever has
+    queued up, at most _MAX_BATCH at a time, and runs it in one transaction,
+    each write in a savepoint of its own so one failing write does not undo
+    the others. The futures are resolved once the transaction is committed.
+    """
+
+    def __init__(self, file):
+        super().__init__(name='database-writer', daemon=True)
+        self.file = file
+        self.queue = queue.Queue()
+        self.ready = Future()
+
+    def run(self):
+        try:
+            self.connection = sqlite3.connect(self.file, timeout=30, isolation_level=None)
+            self.connection.row_factory = sqlite3.Row
+            # Lets readers, and other worker processes, read while we write
+            self.connection.execute('PRAGMA journal_mode=WAL')
+        except BaseException as e:
+            self.ready.set_exception(e)
+            return
+        self.ready.set_result(None)
+
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < _MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+
+            run = []
+            for item in batch:
+                fn, future, transaction = item
+                if transaction:
+                    run.append(item)
+                    continue
+                self._run_batch(run)
+                run = []
+                self._run_alone(fn, future)
+            self._run_batch(run)
+        self.connection.close()
+
+    def _run_alone(self, fn, future):
+        cur = self.connection.cursor()
+        try:
+            future.set_result(fn(cur))
+        except BaseException as e:
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            future.set_exception(e)
+        finally:
+            cur.close()
+
+    def _run_batch(self, batch):
+        if not batch:
+            return
+        cur = self.connection.cursor()
+        outcomes = []
+        try:
+            # IMMEDIATE takes the write lock up front, so the reads a write
+            # makes, like the lease checks, see what it is about to change
+            cur.execute('BEGIN IMMEDIATE')
+            for fn, future, _ in batch:
+                cur.execute('SAVEPOINT write')
+                try:
+                    outcomes.append((future, fn(cur), None))
+                    cur.execute('RELEASE write')
+                except Exception as e:
+                    cur.execute('ROLLBACK TO write')
+                    cur.execute('RELEASE write')
+                    outcomes.append((future, None, e))
+            cur.execute('COMMIT')
+        except BaseException as e:
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        finally:
+            cur.close()
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+_MAX_BATCH = 500
+"""The most writes the writer commits in one transaction"""
+
+_file = None
+_writer = None
+_local = threading.local()
+_read_connections = []
+_read_connections_lock = threading.Lock()
+
 def connect(file):
     """Initiates the connection to the database
 
+    Starts the writer thread. Reading threads open their own connection the
+    first time they read.
+
     Args:
         file: The file to connect to
     """
-    global connection
-    connection = sqlite3.connect(file)
-    connection.row_factory = sqlite3.Row
+    global _file, _writer
+    _file = file
+    _writer = _Writer(file)
+    _writer.start()
+    _writer.ready.result()
 
 def close():
-    """Close the connection"""
-    global connection
-    connection.commit()
-    connection.close()
-    connection = None
+    """Waits for the queued writes to be committed, then closes every connection"""
+    global _file, _writer
+    _writer.queue.put(None)
+    _writer.join()
+    with _read_connections_lock:
+        for connection in _read_connections:
+            connection.close()
+        _read_connections.clear()
+    _local.__dict__.clear()
+    _file = None
+    _writer = None
+
+def _submit(fn, transaction=True):
+    future = Future()
+    _writer.queue.put((fn, future, transaction))
+    return future
+
+def _write(fn, wait):
+    """Queues fn(cursor) on the writer
+
+    Args:
+        fn: The function doing the write, given a cursor
+        wait: If True wait for the write to be committed and return what
+            fn returned, otherwise return a concurrent.futures.Future
+
+    Returns:
+        The result of fn or a Future of it, see wait
+    """
+    future = _submit(fn)
+    return future.result() if wait else future
+
+def _read_connection():
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(f'file:{_file}?mode=ro', uri=True, timeout=30, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        with _read_connections_lock:
+            _read_connections.append(connection)
+        _local.connection = connection
+    return connection
+
+def _read(fn):
+    """Runs fn(cursor) on this thread's read only connection
+
+    An in memory database is private to its connection, so its reads go
+    through the writer instead.
+    """
+    if _file == ':memory:':
+        return _submit(fn).result()
+    cur = _read_connection().cursor()
+    try:
+        return fn(cur)
+    finally:
+        cur.close()
+
+def _create_tables(cur):
+    cur.execute('CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY, dgroup_name TEXT, created_at REAL)')
+    cur.execute('CREATE TABLE IF NOT EXISTS adverts (id INTEGER PRIMARY KEY, group_id INTEGER,'\
+        'found_at REAL, updated_at REAL, posted_at REAL, link TEXT, ns INTEGER NOT NULL DEFAULT 0)')
+    cur.execute('CREATE INDEX IF NOT EXISTS ansgid ON adverts (ns, group_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS apat ON adverts (posted_at)')
+    cur.execute('CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY, reason TEXT, queued_at REAL)')
+    cur.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+    cur.execute('CREATE TABLE IF NOT EXISTS leases (item TEXT PRIMARY KEY, owner TEXT, expires_at REAL) WITHOUT ROWID')
+
+def _migrate_text_ids(cur):
+    """Migrates the original schema, with text ids, to integer ids.
+
+    Every row is copied in a single transaction, so a failure leaves the
+    original tables untouched.
+    """
+    cur.execute('PRAGMA table_info(adverts)')
+    if 'link' not in (row['name'] for row in cur.fetchall()):
+        cur.execute('ALTER TABLE adverts ADD COLUMN link TEXT')
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pending'")
+    has_pending = cur.fetchone() is not None
+
+    cur.execute('ALTER TABLE groups RENAME TO groups_v0')
+    cur.execute('ALTER TABLE adverts RENAME TO adverts_v0')
+    if has_pending:
+        cur.execute('ALTER TABLE pending RENAME TO pending_v0')
+    cur.execute('DROP INDEX IF EXISTS gdgid')
+    cur.execute('DROP INDEX IF EXISTS afn')
+    _create_tables(cur)
+
+    cur.connection.create_function('id_from_fullname', 1, id_from_fullname)
+    cur.execute('INSERT OR IGNORE INTO groups (id, dgroup_name, created_at) '\
+        'SELECT CAST(dgroup_id AS INTEGER), dgroup_name, created_at FROM groups_v0')
+    cur.execute('INSERT OR IGNORE INTO adverts (id, group_id, found_at, updated_at, posted_at, link) '\
+        'SELECT id_from_fullname(a.fullname), CAST(g.dgroup_id AS INTEGER), a.found_at, a.updated_at, a.posted_at, a.link '\
+        'FROM adverts_v0 a JOIN groups_v0 g ON g.id = a.group_id')
+    if has_pending:
+        cur.execute('INSERT OR IGNORE INTO pending (id, reason, queued_at) '\
+            'SELECT id_from_fullname(fullname), reason, queued_at FROM pending_v0')
+        cur.execute('DROP TABLE pending_v0')
+    cur.execute('DROP TABLE adverts_v0')
+    cur.execute('DROP TABLE groups_v0')
+
+def _create_missing_tables(cur):
+    cur.execute('BEGIN IMMEDIATE')
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+    migrated = False
+    if version < 1:
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='groups'")
+        if cur.fetchone() is not None:
+            logger.info('Migrating database to integer ids')
+            _migrate_text_ids(cur)
+            migrated = True
+    elif version < 2:
+        cur.execute('ALTER TABLE adverts ADD COLUMN ns INTEGER NOT NULL DEFAULT 0')
+        cur.execute('DROP INDEX IF EXISTS agid')
+    _create_tables(cur)
+    cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    cur.execute('COMMIT')
+    if migrated:
+        # Give the space freed by the smaller rows back to the filesystem
+        cur.execute('VACUUM')
 
 def create_missing_tables():
-    """Create all missing tables"""
-    global connection
-    cur = connection.cursor()
-    cur.execute('CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY AUTOINCREMENT,'\
-        'dgroup_name TEXT, dgroup_id TEXT UNIQUE, created_at REAL)')
-    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS gdgid ON groups (dgroup_id)')
-    cur.execute('CREATE TABLE IF NOT EXISTS adverts (id INTEGER PRIMARY KEY AUTOINCREMENT,'\
-        'fullname TEXT, permalink TEXT, group_id INT, found_at REAL, updated_at REAL, posted_at REAL,'\
-        'FOREIGN KEY(group_id) REFERENCES groups(id))')
-    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS afn ON adverts (fullname)')
-    connection.commit()
-    cur.close()
+    """Create all missing tables, migrating older schemas to SCHEMA_VERSION"""
+    # The migration manages its own transaction, as VACUUM cannot run in one
+    _submit(_create_missing_tables, transaction=False).result()
 
 def fetch_group_by_dgroup_id(dgroup_id):
     """Fetch our internal group representation of the given discord group id
@@ -66,44 +379,36 @@ def fetch_group_by_dgroup_id(dgroup_id):
         Dictionary of our internal representation of the group, see class
         comments for details. None if we have no saved representation.
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('SELECT * FROM groups WHERE dgroup_id=?', (dgroup_id,))
-    row = cur.fetchone()
-    res = dict(row) if row != None else None
-    cur.close()
-    return res
+    return fetch_group_by_id(int(dgroup_id))
 
 def fetch_group_by_id(id):
     """Fetch our internal group representation from our internal group id
 
     Args:
-        id: The int id we assigned to this group
+        id: The int id of the group, which is its discord snowflake
 
     Returns:
         Dictionary of our representation of the group, see class comments
         for details. None if we have no saved representation
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('SELECT * FROM groups WHERE id=?', (id,))
-    row = cur.fetchone()
-    res = dict(row) if row != None else None
-    cur.close()
-    return res
+    def read(cur):
+        cur.execute('SELECT * FROM groups WHERE id=?', (id,))
+        return _group_dict(cur.fetchone())
+    return _read(read)
 
-def save_group(dgroup_name, dgroup_id):
+def save_group(dgroup_name, dgroup_id, wait=True):
     """Saves the discord group and id to our internal mapping
 
     Args:
         dgroup_name: the string name of the discord group
-        dgroup_id: the string identifier of the discord group
+        dgroup_id: the string identifier of the discord group. Nothing is
+            saved if another worker saved the group first.
+        wait: False to return a Future instead of waiting for the commit
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('INSERT INTO groups (dgroup_name, dgroup_id, created_at) values(?, ?, ?)', (dgroup_name, dgroup_id, time.time()))
-    connection.commit()
-    cur.close()
+    now = time.time()
+    def write(cur):
+        cur.execute('INSERT OR IGNORE INTO groups (id, dgroup_name, created_at) values(?, ?, ?)', (int(dgroup_id), dgroup_name, now))
+    return _write(write, wait)
 
 def fetch_advert_by_fullname(fullname):
     """Fetches the saved advert for the given fullname
@@ -116,79 +421,276 @@ def fetch_advert_by_fullname(fullname):
         class comments for details. None if we have no saved adverts for
         the submission.
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('SELECT * FROM adverts WHERE fullname=?', (fullname,))
-    row = cur.fetchone()
-    res = dict(row) if row != None else None
-    cur.close()
-    return res
+    def read(cur):
+        cur.execute('SELECT * FROM adverts WHERE id=?', (id_from_fullname(fullname),))
+        return _advert_dict(cur.fetchone())
+    return _read(read)
 
-def fetch_adverts_by_group_id(group_id):
+def fetch_adverts_by_group_id(group_id, namespace=0):
     """Fetches the adverts we know about associated with the given group
 
     Args:
         group_id: The group id of the row in our database
+        namespace: The namespace of the subreddit to fetch adverts from
 
     Returns:
         A list of dictionaries of adverts. Empty list if no adverts found.
         See class comments for details on what an advert looks like.
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('SELECT * FROM adverts WHERE group_id=?', (group_id,))
-    rows = cur.fetchall()
-    res = list(dict(row) for row in rows)
-    cur.close()
-    return res
+    def read(cur):
+        cur.execute('SELECT * FROM adverts WHERE ns=? AND group_id=?', (namespace, group_id))
+        return list(_advert_dict(row) for row in cur.fetchall())
+    return _read(read)
 
-def save_advert(fullname, permalink, group_id, posted_at):
+def iter_adverts_with_groups(batch_size=1000):
+    """Streams every advert along with the group it advertises.
+
+    Args:
+        batch_size: How many rows to fetch from sqlite at a time
+
+    Yields:
+        Dictionaries of the advert row with the dgroup_id and dgroup_name of
+        its group added, ordered by group.
+    """
+    query = 'SELECT a.*, g.dgroup_name FROM adverts a JOIN groups g ON g.id = a.group_id ORDER BY a.group_id'
+    if _file == ':memory:':
+        def read(cur):
+            cur.execute(query)
+            return cur.fetchall()
+        for row in _read(read):
+            yield _advert_dict(row)
+        return
+
+    cur = _read_connection().cursor()
+    cur.execute(query)
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield _advert_dict(row)
+    finally:
+        cur.close()
+
+def save_advert(fullname, permalink, group_id, posted_at, link=None, namespace=0, wait=True):
     """Saves the advert that we just found.
 
     Args:
         fullname: The reddit fullname of the submission the advert is on
-        permalink: A link to the submission
+        permalink: A link to the submission. Not stored; the permalink is
+            derived from the fullname.
         group_id: The id of the row in our groups table associated with the discord group
         posted_at: When the submission was posted, in unix time seconds
+        link: The url the submission links to
+        namespace: The namespace of the subreddit the submission is in
+        wait: False to return a Future instead of waiting for the commit
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('INSERT INTO adverts (fullname, permalink, group_id, found_at, updated_at, posted_at) VALUES (?, ?, ?, ?, ?, ?)',\
-        (fullname, permalink, group_id, time.time(), time.time(), posted_at))
-    connection.commit()
-    cur.close()
+    now = time.time()
+    def write(cur):
+        cur.execute('INSERT INTO adverts (id, group_id, found_at, updated_at, posted_at, link, ns) VALUES (?, ?, ?, ?, ?, ?, ?)',\
+            (id_from_fullname(fullname), group_id, now, now, posted_at, link, namespace))
+    return _write(write, wait)
 
-def touch_advert(id):
+def touch_advert(id, wait=True):
     """Update the updated_at for the given advert to now
 
     Args:
         id: the id of the advert you want to touch
+        wait: False to return a Future instead of waiting for the commit
+    """
+    now = time.time()
+    def write(cur):
+        cur.execute('UPDATE adverts SET updated_at=? WHERE id=?', (now, id))
+    return _write(write, wait)
+
+def expire_advert(id, wait=True):
+    """Mark the given advert as needing to be checked again
+
+    Args:
+        id: the id of the advert you want to expire
+        wait: False to return a Future instead of waiting for the commit
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('UPDATE adverts SET updated_at=? WHERE id=?', (time.time(), id))
-    connection.commit()
-    cur.close()
+    def write(cur):
+        cur.execute('UPDATE adverts SET updated_at=0 WHERE id=?', (id,))
+    return _write(write, wait)
 
-def delete_advert(id):
+def delete_advert(id, wait=True):
     """Delete the advert with the given id
 
     Args:
         id: the id of the advert you want to delete
+        wait: False to return a Future instead of waiting for the commit
+    """
+    def write(cur):
+        cur.execute('DELETE FROM adverts WHERE id=?', (id,))
+    return _write(write, wait)
+
+def save_pending(fullname, reason, wait=True):
+    """Queues the submission to be handled again by the scan loop
+
+    Args:
+        fullname: the reddit fullname of the submission
+        reason: a short string describing why it was queued
+        wait: False to return a Future instead of waiting for the commit
     """
-    global connection
-    cur = connection.cursor()
-    cur.execute('DELETE FROM adverts WHERE id=?', (id,))
-    connection.commit()
-    cur.close()
+    now = time.time()
+    def write(cur):
+        cur.execute('INSERT OR REPLACE INTO pending (id, reason, queued_at) VALUES (?, ?, ?)', (id_from_fullname(fullname), reason, now))
+    return _write(write, wait)
 
-def prune():
-    """Prunes old entries from the database"""
-    global connection
+def fetch_pending():
+    """Fetches the queued submissions, oldest first
 
+    Returns:
+        A list of dictionaries of pending rows. Empty list if nothing is
+        queued. See class comments for details.
+    """
+    def read(cur):
+        cur.execute('SELECT * FROM pending ORDER BY queued_at')
+        return list({ 'fullname': f't3_{id36_from_id(row["id"])}', 'reason': row['reason'], 'queued_at': row['queued_at'] } for row in cur.fetchall())
+    return _read(read)
+
+def delete_pending(fullname, wait=True):
+    """Remove the submission from the queue
+
+    Args:
+        fullname: the reddit fullname of the submission
+        wait: False to return a Future instead of waiting for the commit
+    """
+    def write(cur):
+        cur.execute('DELETE FROM pending WHERE id=?', (id_from_fullname(fullname),))
+    return _write(write, wait)
+
+def save_state(values, wait=True):
+    """Saves the given checkpoint values, replacing any saved before
+
+    Args:
+        values: dict of string key to a json serializable value
+        wait: False to return a Future instead of waiting for the commit
+    """
+    rows = list((key, json.dumps(value)) for key, value in values.items())
+    def write(cur):
+        cur.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', rows)
+    return _write(write, wait)
+
+def fetch_state():
+    """Fetches every saved checkpoint value
+
+    Returns:
+        A dict of string key to the saved value. Empty dict if nothing has
+        been saved.
+    """
+    def read(cur):
+        cur.execute('SELECT key, value FROM state')
+        return dict((row['key'], json.loads(row['value'])) for row in cur.fetchall())
+    return _read(read)
+
+def claim_lease(item, owner, lease_seconds):
+    """Claims or renews the lease on the item, unless someone else holds it
+
+    Args:
+        item: the string naming what to claim
+        owner: the string identifying the worker claiming it
+        lease_seconds: how long the claim lasts unless renewed
+
+    Returns:
+        True if the owner now holds the lease, False if another owner does
+    """
+    def write(cur):
+        now = time.time()
+        # Not an upsert, which needs sqlite 3.24
+        cur.execute('INSERT OR IGNORE INTO leases (item, owner, expires_at) VALUES (?, ?, ?)', (item, owner, now + lease_seconds))
+        if cur.rowcount == 1:
+            return True
+        cur.execute('UPDATE leases SET owner=?, expires_at=? WHERE item=? AND (owner=? OR expires_at < ?)',
+            (owner, now + lease_seconds, item, owner, now))
+        return cur.rowcount == 1
+    return _write(write, True)
+
+def holds_lease(item, owner):
+    """Checks that the owner holds an unexpired lease on the item
+
+    Args:
+        item: the string naming what was claimed
+        owner: the string identifying the worker
+
+    Returns:
+        True if the owner holds the lease, False otherwise
+    """
+    def read(cur):
+        cur.execute('SELECT 1 FROM leases WHERE item=? AND owner=? AND expires_at > ?', (item, owner, time.time()))
+        return cur.fetchone() is not None
+    return _read(read)
+
+def release_lease(item, owner, wait=True):
+    """Gives up the lease on the item, if the owner holds it
+
+    Args:
+        item: the string naming what was claimed
+        owner: the string identifying the worker
+        wait: False to return a Future instead of waiting for the commit
+    """
+    def write(cur):
+        cur.execute('DELETE FROM leases WHERE item=? AND owner=?', (item, owner))
+    return _write(write, wait)
+
+def release_leases(owner, wait=True):
+    """Gives up every lease the owner holds
+
+    Args:
+        owner: the string identifying the worker
+        wait: False to return a Future instead of waiting for the commit
+    """
+    def write(cur):
+        cur.execute('DELETE FROM leases WHERE owner=?', (owner,))
+    return _write(write, wait)
+
+def refresh_partitions(owner, num_partitions, lease_seconds):
+    """Renews the owner's heartbeat and rebalances the partitions it holds
+
+    Every live worker holds a worker:<owner> lease. Each one takes an equal
+    share of the partitions: it keeps and renews up to its share, releases
+    any beyond it and claims free or expired partitions to make it up. This
+    runs in one transaction, so two workers never claim the same partition.
+
+    Args:
+        owner: the string identifying the worker
+        num_partitions: how many partitions the work is split into
+        lease_seconds: how long the heartbeat and partition leases last
+
+    Returns:
+        A sorted list of the int partitions the owner now holds
+    """
+    def write(cur):
+        now = time.time()
+        expires_at = now + lease_seconds
+        cur.execute('DELETE FROM leases WHERE expires_at < ?', (now,))
+        cur.execute('INSERT OR REPLACE INTO leases (item, owner, expires_at) VALUES (?, ?, ?)', (f'worker:{owner}', owner, expires_at))
+        cur.execute("SELECT COUNT(*) FROM leases WHERE item LIKE 'worker:%'")
+        share = math.ceil(num_partitions / cur.fetchone()[0])
+
+        cur.execute("SELECT item, owner FROM leases WHERE item LIKE 'partition:%'")
+        taken = dict((int(row['item'][len('partition:'):]), row['owner']) for row in cur.fetchall())
+        held = sorted(partition for partition, holder in taken.items() if holder == owner and partition < num_partitions)
+        free = [partition for partition in range(num_partitions) if partition not in taken]
+
+        for partition in held[share:]:
+            cur.execute('DELETE FROM leases WHERE item=?', (f'partition:{partition}',))
+        held = held[:share] + free[:max(share - len(held), 0)]
+        cur.executemany('INSERT OR REPLACE INTO leases (item, owner, expires_at) VALUES (?, ?, ?)',
+            ((f'partition:{partition}', owner, expires_at) for partition in held))
+        return sorted(held)
+    return _write(write, True)
+
+def prune(wait=True):
+    """Prunes old entries from the database
+
+    Args:
+        wait: False to return a Future instead of waiting for the commit
+    """
     one_day_ago = time.time() - 60 * 60 * 24
-    cur = connection.cursor()
-    cur.execute('DELETE FROM adverts WHERE posted_at < ?', (one_day_ago,))
-    cur.execute('DELETE FROM groups WHERE id NOT IN (SELECT group_id FROM adverts a)')
-    connection.commit()
-    cur.close()
+    def write(cur):
+        cur.execute('DELETE FROM adverts WHERE posted_at < ?', (one_day_ago,))
+        cur.execute('DELETE FROM groups WHERE id NOT IN (SELECT group_id FROM adverts a)')
+    return _write(write, wait)
@@ -6,12 +6,25 @@ This module allows for interaction with the Discord API
 from urllib.request import urlopen
 from urllib.request import Request
 from urllib.error import HTTPError
+from urllib.error import URLError
 
 import urllib
 import json
+import socket
 
 import time
 import math
+import asyncio
+import logging
+
+import concurrency
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
 
 API_BASE = 'https://discordapp.com/api/'
 """The base URL for discord api requests"""
@@ -19,11 +32,67 @@ API_BASE = 'https://discordapp.com/api/'
 USER_AGENT = 'python urllib3 reddit u/tjstretchalot'
 """The user agent for interacting with discord"""
 
-def get_invite_from_code(code):
+TIMEOUT_SECONDS = 10
+"""How long a request may take before it is abandoned"""
+
+def _headers():
+    """The headers to send with every request to discord"""
+    global USER_AGENT
+
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'User-Agent': USER_AGENT,
+        'Authorization': 'Bot NTkyMjAwODQ2MjQzMjY2NTkw.XQ74OQ.Oafs1hFDzSt7pEwH8kKtly4PUo0'
+    }
+
+def _parse_invite(data):
+    """Interprets the body of a successful invite request.
+
+    Args:
+        data: The decoded json body
+
+    Returns:
+        The tuple to return from get_invite_from_code
+    """
+    if data['code'] == '10006':
+        # This is a special code to indicate the link just expired
+        return False, False, None
+    return True, False, data
+
+def _ratelimit_wait(code, headers):
+    """Finds how long to wait after being ratelimited.
+
+    Args:
+        code: The invite code we were checking, for logging
+        headers: The headers of the 429 response
+
+    Returns:
+        The number of seconds to wait before trying again, which is 0 if the
+        reset time is in the past, or None if discord did not say.
+    """
+    if 'X-RateLimit-Reset' not in headers:
+        return None
+
+    reset_time = float(headers['X-RateLimit-Reset'])
+    time_to_wait = math.ceil(reset_time - time.time())
+    if time_to_wait <= 0:
+        logger.warning('got ratelimited when checking %s but the reset time is in the past, trying again', code)
+        return 0
+    logger.warning('got ratelimited when checking %s, need to wait %s seconds before trying again', code, time_to_wait)
+    return time_to_wait
+
+def get_invite_from_code(code, bucket=None):
     """Fetch the invite object given just its code.
 
+    The request is abandoned after TIMEOUT_SECONDS.
+
     Args:
         code (str): The invite code, unique to the invitation
+        bucket: The ratelimit.TokenBucket to take a token from before the
+            request. When discord ratelimits us anyway the bucket is
+            penalized, rather than this call sleeping, so everyone sharing
+            the bucket backs off.
 
     Returns:
         A tuple of three values.
@@ -56,33 +125,98 @@ def get_invite_from_code(code):
             }
     """
     global API_BASE
-    global USER_AGENT
 
-    req = Request(f'{API_BASE}invites/{code}')
-    req.add_header('Accept', 'application/json')
-    req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-    req.add_header('User-Agent', USER_AGENT)
-    req.add_header('Authorization', 'Bot NTkyMjAwODQ2MjQzMjY2NTkw.XQ74OQ.Oafs1hFDzSt7pEwH8kKtly4PUo0')
+    if bucket is not None:
+        bucket.acquire()
+
+    req = Request(f'{API_BASE}invites/{code}', headers=_headers())
     try:
-        with urlopen(req) as res:
-            data = json.loads(res.read().decode('utf-8'))
-            if data['code'] == '10006':
-                # This is a special code to indicate the link just expired
-                return False, False, None
-            return True, False, data
+        with concurrency.limiter_for(API_BASE).slot() as slot:
+            try:
+                with urlopen(req, timeout=TIMEOUT_SECONDS) as res:
+                    body = res.read()
+            except HTTPError as err:
+                if err.code == 429:
+                    slot.outcome = concurrency.OVERLOADED
+                raise
+            except (socket.timeout, URLError) as err:
+                if isinstance(err, socket.timeout) or isinstance(getattr(err, 'reason', None), socket.timeout):
+                    slot.outcome = concurrency.OVERLOADED
+                raise
+        return _parse_invite(json.loads(body.decode('utf-8')))
     except HTTPError as err:
         if err.code == 404:
             return False, False, None
         if err.code == 429:
-            if 'X-RateLimit-Reset' in err.headers:
-                reset_time = err.headers['X-RateLimit-Reset']
-                time_to_wait = math.ceil(reset_time - time.time())
-                if time_to_wait <= 0:
-                    print(f'got ratelimited when checking {code} but the reset time is in the past, trying again')
-                    return False, True, None
-                print(f'got ratelimited when checking {code}, need to wait {time_to_wait} seconds before trying again')
-                time.sleep(time_to_wait)
+            time_to_wait = _ratelimit_wait(code, err.headers)
+            if time_to_wait is not None:
+                if bucket is not None:
+                    bucket.penalize(time_to_wait)
+                else:
+                    time.sleep(time_to_wait)
                 return False, True, None
 
-        print(f'Got error code {err.code} in HTTPResponse for code {code}')
+        logger.warning('Got error code %s in HTTPResponse for code %s', err.code, code)
+        return False, True, None
+    except (socket.timeout, URLError) as err:
+        logger.warning('Got %s fetching code %s', err, code)
+        return False, True, None
+
+async def get_invite_from_code_async(code, session=None, bucket=None):
+    """Fetch the invite object given just its code, without blocking.
+
+    The request is abandoned after TIMEOUT_SECONDS, and cancelling the
+    calling task cancels the request.
+
+    Args:
+        code (str): The invite code, unique to the invitation
+        session: The aiohttp.ClientSession to use. Defaults to a new session
+            just for this request; pass one in when making many requests.
+
+    Returns:
+        The same tuple as get_invite_from_code
+    """
+    global API_BASE
+
+    if aiohttp is None:
+        raise ModuleNotFoundError('aiohttp is required for async requests')
+
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await get_invite_from_code_async(code, session, bucket)
+
+    if bucket is not None:
+        await bucket.acquire_async()
+
+    try:
+        async with concurrency.limiter_for(API_BASE).slot_async() as slot:
+            try:
+                async with session.get(f'{API_BASE}invites/{code}', headers=_headers(),
+                        timeout=aiohttp.ClientTimeout(total=TIMEOUT_SECONDS)) as res:
+                    status, headers = res.status, res.headers
+                    data = await res.json(content_type=None) if status == 200 else None
+            except asyncio.TimeoutError:
+                slot.outcome = concurrency.OVERLOADED
+                raise
+            if status == 429:
+                slot.outcome = concurrency.OVERLOADED
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        logger.warning('Got %s fetching code %s', type(err).__name__, code)
         return False, True, None
+
+    if status == 200:
+        return _parse_invite(data)
+    if status == 404:
+        return False, False, None
+    if status == 429:
+        time_to_wait = _ratelimit_wait(code, headers)
+        if time_to_wait is not None:
+            if bucket is not None:
+                # A shared bucket writes to sqlite, which may block
+                await asyncio.get_event_loop().run_in_executor(None, bucket.penalize, time_to_wait)
+            else:
+                await asyncio.sleep(time_to_wait)
+            return False, True, None
+
+    logger.warning('Got error code %s in HTTPResponse for code %s', status, code)
+    return False, True, None
@@ -5,21 +5,65 @@
 import discord
 import redirects
 import retry
+import links
+import aioresolve
+import concurrency
 import config
-from stringlist import StringList
+import community
+import workers
+from singleflight import SingleFlight
+from pacing import Pacer
+from ratelimit import SharedTokenBucket
+from watchdog import Watchdog, StallError
+import log
+import logging
 import time
+import sys
+import signal
+import argparse
 import praw
-import string # for variable "print_safe_name"
 import database
 import math
 from datetime import timedelta
 
+parser = argparse.ArgumentParser(description='Moderates discord server adverts on reddit')
+parser.add_argument('--workers', type=int, help='run this many worker processes, which split the submissions between them')
+parser.add_argument('--worker', metavar='NAME', help='run as one of the worker processes, under the given name')
+args = parser.parse_args()
+
+log.setup()
+logger = logging.getLogger('discordservers')
+
+if args.workers:
+    workers.supervise(args.workers, __file__)
+    sys.exit(0)
+
 try:
     import auth_config
 except ModuleNotFoundError as e:
     print('You must create a file \'auth_config.py\' with the values client_id, client_secret, password, and username')
     raise e
 
+worker = None
+"""The workers.Worker if we are one of several worker processes"""
+
+invite_flight = SingleFlight(config.coalesce_ttl_seconds)
+"""Coalesces invite lookups for the same code"""
+
+redirect_flight = SingleFlight(config.coalesce_ttl_seconds)
+"""Coalesces redirect lookups for the same url"""
+
+consumer = 'shadow' if config.dry_run else 'scan'
+"""What kind of process we are, for sharing request budgets with the others
+on the host"""
+
+discord_bucket = SharedTokenBucket(config.ratelimit_file, 'discord', config.discord_requests_per_second,
+    config.discord_bucket_capacity, config.discord_reserve_tokens[consumer])
+"""The discord request budget shared with every process on the host"""
+
+watchdog = Watchdog(config.watchdog_stall_seconds, config.submission_deadline_seconds)
+"""Watches the scan loop for stalls and submissions that take too long"""
+
 def is_official_link(link):
     """Determine if the given link is official.
 
@@ -32,10 +76,7 @@ def is_official_link(link):
         True if the link is a link to discord, False otherwise.
     """
 
-    return (link.startswith('http://discord.gg')
-        or link.startswith('https://discord.gg')
-        or link.startswith('http://discordapp.com')
-        or link.startswith('https://discordapp.com'))
+    return links.classify(link)[0] == links.OFFICIAL
 
 def get_code_from_official_link(link):
     """Finds the code for the official invite link.
@@ -44,13 +85,11 @@ def get_code_from_official_link(link):
         link: A string url that corresponds with a discord invite link.
 
     Returns:
-        The string code that the invite link uses.
+        The string code that the invite link uses, or None if the link does
+        not contain an invite code.
     """
 
-    if link.endswith('/'):
-        return link.rsplit('/', 2)[-2]
-
-    return link.rsplit('/', 1)[-1]
+    return links.classify(link)[1]
 
 def is_whitelisted_redir(link):
     """Determines if the given link is a whitelisted redirector.
@@ -62,14 +101,7 @@ def is_whitelisted_redir(link):
         True if the url is a whitelisted redirector, False otherwise.
     """
 
-    return (link.startswith('http://discord.plus')
-        or link.startswith('https://discord.plus')
-        or link.startswith('http://discord.link')
-        or link.startswith('https://discord.link')
-        or link.startswith('http://invite.gg')
-        or link.startswith('https://invite.gg')
-        or link.startswith('http://discord.st')
-        or link.startswith('https://discord.st'))
+    return links.classify(link)[0] == links.REDIRECT
 
 def is_discord_or_discord_redirect_link(link):
     """Determines if the given link is either discord or redirect to discord.
@@ -83,12 +115,30 @@ def is_discord_or_discord_redirect_link(link):
         True if the url is a discord link or a redirect to one, False otherwise
     """
 
-    return is_official_link(link) or is_whitelisted_redir(link)
+    return links.classify(link)[0] is not None
 
 def follow_redir_link(link):
     """Follows the redirect link until we reach the official discord link.
 
-    This will retry forever.
+    This will retry for up to config.lookup_timeout_seconds. Lookups of the
+    same link that are running at the same time or finished recently share
+    one result.
+
+    Args:
+        link: A string url
+
+    Returns:
+        The string url that the original link points to.
+    """
+
+    result, elapsed, shared = redirect_flight.do(link, _follow_redir_link, link)
+    logger.debug('  %s a redirect lookup for %s (%.2fs)', "Reused" if shared else "Did", link, elapsed)
+    return result
+
+def _follow_redir_link(link):
+    """Follows the redirect link until we reach the official discord link.
+
+    This will retry for up to config.lookup_timeout_seconds.
 
     Args:
         link: A string url
@@ -110,12 +160,31 @@ def follow_redir_link(link):
 
         return True, result
 
-    return retry.until_success(try_follow_redirect)
+    return retry.until_success(try_follow_redirect, timeout=config.lookup_timeout_seconds)
 
 def get_invite_from_code(code):
     """Get the discord invite from the code.
 
-    This will retry unless we don't think retrying will help.
+    This will retry unless we don't think retrying will help, for up to
+    config.lookup_timeout_seconds. Lookups of the same code that are running
+    at the same time or finished recently share one result.
+
+    Args:
+        code: The string discord invite code
+
+    Returns:
+        The discord invite object (see discord.py)
+    """
+
+    result, elapsed, shared = invite_flight.do(code, _get_invite_from_code, code)
+    logger.debug('  %s an invite lookup for %s (%.2fs)', "Reused" if shared else "Did", code, elapsed)
+    return result
+
+def _get_invite_from_code(code):
+    """Get the discord invite from the code.
+
+    This will retry unless we don't think retrying will help, for up to
+    config.lookup_timeout_seconds.
 
     Args:
         code: The string discord invite code
@@ -127,15 +196,15 @@ def get_invite_from_code(code):
     def try_get_invite_from_code():
         nonlocal code
 
-        succ, retry, result = discord.get_invite_from_code(code)
+        succ, retry, result = discord.get_invite_from_code(code, discord_bucket)
         if succ:
             return True, result
 
         return not retry, None
 
-    return retry.until_success(try_get_invite_from_code)
+    return retry.until_success(try_get_invite_from_code, timeout=config.lookup_timeout_seconds)
 
-def reply_and_delete_submission(subm, msg = None, indent = '   '):
+def reply_and_delete_submission(subm, comm, msg = None, indent = '   '):
     """Responds with the default message, distinguishes response, and deletes
 
     This is the correct course of action for a link to an invalid discord channel,
@@ -143,39 +212,90 @@ def reply_and_delete_submission(subm, msg = None, indent = '   '):
 
     Args:
         subm: The praw.models.reddit.Submission object
-        msg: The string message to reply with, or None for config.response_message
+        comm: The community.Community the submission is in
+        msg: The string message to reply with, or None for the community's response_message
         indent: The indent to use for logging, defaults to 4 spaces
+
+    Returns:
+        True if the submission was removed, or would have been in a dry-run.
+        False if we may not act on it or removing it failed.
     """
 
     if msg is None:
-        msg = config.response_message
+        msg = comm.response_message
+
+    if not can_act(subm, indent):
+        return False
 
     if config.dry_run:
-        print(f'{indent}Would reply and remove, but dry-run is set. Waiting 2 seconds instead')
+        logger.info('%sWould reply and remove, but dry-run is set. Waiting 2 seconds instead', indent)
         time.sleep(2)
-        return
+        return True
     try:
         comment = subm.reply(msg)
         comment.mod.distinguish()
-        print(f'{indent}Done replying, removing')
+        logger.info('%sDone replying, removing', indent)
         subm.mod.remove(spam=False)
-        print(f'{indent}Done removing')
-    except Exception as ReplyAndDeleteException:
-        print(f'Error encountered while handling reply-and-delete:\r\n{ReplyAndDeleteException}\r\n')
-        pass
+        logger.info('%sDone removing', indent)
+        return True
+    except Exception:
+        logger.exception('Error encountered while handling reply-and-delete')
+        return False
+
+def can_act(subm, indent = '  '):
+    """Checks that we may take moderator actions on the submission.
 
-def make_printable(str):
-    """Takes a string and makes it printable
+    When we are one of several workers this is only the case while we hold
+    the lease on the submission and its partition, so that two workers never
+    act on it.
 
     Args:
-        str: The string to make printable
+        subm: The praw.models.reddit.Submission object
+        indent: The indent to use for logging
 
     Returns:
-        The string with all weird characters filtered
+        True if we may act on the submission, False otherwise
+    """
+    if worker is None or (worker.owns(subm.id) and worker.holds(subm.id)):
+        return True
+
+    logger.info('%sNot acting; our claim on %s has lapsed and another worker may be handling it', indent, subm.id)
+    return False
+
+def handle_claimed(subm, comm, classification=None):
+    """Claims the submission if we are one of several workers, then handles it.
+
+    The submission is skipped if handling it takes longer than
+    config.submission_deadline_seconds or a lookup gives up, so that one
+    stuck submission does not hold up the scan.
+
+    Args:
+        subm: The praw.models.reddit.Submission object
+        comm: The community.Community the submission is in
+        classification: See handle_submission
     """
-    return ''.join(filter(lambda x: x in set(string.printable), str))
+    with log.context(submission=subm.id, subreddit=comm.name):
+        try:
+            with watchdog.operation(f'handling submission {subm.id}'):
+                # The listing may be older than our partitions; owns also
+                # renews our heartbeat, which a long scan would let lapse
+                if worker is not None and not worker.owns(subm.id):
+                    logger.info('Skipping submission %s; its partition moved to another worker', subm.id)
+                    return
 
-def handle_submission(subm):
+                if worker is not None and not worker.claim(subm.id):
+                    logger.info('Skipping submission %s; another worker is handling it', subm.id)
+                    return
+
+                try:
+                    handle_submission(subm, comm, classification)
+                finally:
+                    if worker is not None:
+                        worker.release(subm.id)
+        except (StallError, retry.RetryError) as e:
+            logger.warning('Skipping submission %s; %s', subm.id, e)
+
+def handle_submission(subm, comm, classification=None):
     """Performs any actions that are necessary for the given submission.
 
     It may delete the submission, flair the submission, or otherwise perform
@@ -183,148 +303,162 @@ def handle_submission(subm):
 
     Args:
         subm: The praw.models.reddit.Submission object
+        comm: The community.Community the submission is in
+        classification: The (kind, code) tuple from links.classify for the
+            submission url, or None to classify it here
     """
-    global blacklist
 
-    print(f'Handling submission {subm.id} by {subm.author.name if subm.author else None}\n  Link: {subm.url}')
+    logger.info('Handling submission %s in r/%s by %s\n  Link: %s', subm.id, comm.name, subm.author.name if subm.author else None, subm.url)
 
     if subm.is_self:
-        print('  Ignoring; it is a self-post')
+        logger.info('  Ignoring; it is a self-post')
         return
 
     if subm.banned_by is not None:
-        print(f'  Ignoring; the submission was removed by {subm.banned_by}')
+        logger.info('  Ignoring; the submission was removed by %s', subm.banned_by)
         return
 
     if subm.approved_by is not None and subm.approved_by != 'AutoModerator':
-        print(f'  Ignoring; the submission was approved by {subm.approved_by}')
+        logger.info('  Ignoring; the submission was approved by %s', subm.approved_by)
         return
 
     if subm.author is not None:
-        if subm.author.name in whitelist.fetch():
-            print(f'  Ignoring; the submission author is {subm.author.name}')
+        if subm.author.name in comm.whitelist.fetch():
+            logger.info('  Ignoring; the submission author is %s', subm.author.name)
             return
 
-    if not is_discord_or_discord_redirect_link(subm.url):
-        print(f'  Ignoring; the submission links to {subm.url} which is unrecognized')
+    if classification is None:
+        classification = links.classify(subm.url)
+    kind, code = classification
+
+    if kind is None:
+        logger.info('  Ignoring; the submission links to %s which is unrecognized', subm.url)
         return
         
     if subm.score > 5:
-        print('This submission has a score of {subm.score}! Removing..')
-        submission.mod.remove(spam=False)
-        print('    Done removing')
+        logger.info('This submission has a score of %s! Removing..', subm.score)
+        if can_act(subm, '    '):
+            subm.mod.remove(spam=False)
+            logger.info('    Done removing')
 
     advert = database.fetch_advert_by_fullname(subm.fullname)
     group = None
     if advert is not None:
         time_since_touched = time.time() - advert['updated_at']
         group = database.fetch_group_by_id(advert['group_id'])
-        old_group_name_printable = make_printable(group['dgroup_name'])
-        if time_since_touched < config.post_update_time_seconds:
-            print(f'  Ignoring; We have seen this post before (goes to {old_group_name_printable}) and checked it only {time_since_touched} seconds ago')
+        old_group_name_printable = log.printable(group['dgroup_name'])
+        if time_since_touched < comm.post_update_time_seconds:
+            logger.info('  Ignoring; We have seen this post before (goes to %s) and checked it only %s seconds ago', old_group_name_printable, time_since_touched)
             return
 
         time_since_checked_mins = round(time_since_touched / 60)
-        print(f'  When we checked this about {time_since_checked_mins} minutes ago and it went to {old_group_name_printable}')
-
-    official_link = subm.url
-    if is_whitelisted_redir(official_link):
-        official_link = follow_redir_link(official_link)
-        print(f'  After following redirects found final url {official_link}')
+        logger.info('  When we checked this about %s minutes ago and it went to %s', time_since_checked_mins, old_group_name_printable)
 
+    if kind == links.REDIRECT:
+        official_link = follow_redir_link(subm.url)
+        logger.info('  After following redirects found final url %s', official_link)
 
-        if official_link is None or not is_official_link(official_link):
-            print('  Since that is not a valid discord link, replying and deleting...')
-            reply_and_delete_submission(subm)
+        kind, code = links.classify(official_link)
+        if kind != links.OFFICIAL:
+            logger.info('  Since that is not a valid discord link, replying and deleting...')
+            reply_and_delete_submission(subm, comm)
             return
 
-    assert is_official_link(official_link)
+    assert kind == links.OFFICIAL
 
-    code = get_code_from_official_link(official_link)
-    assert code is not None and code != ''
+    if code is None:
+        logger.info('  The discord link does not contain an invite code, replying and deleting...')
+        reply_and_delete_submission(subm, comm)
+        return
 
     invite = get_invite_from_code(code)
     if invite is None:
-        print(f'  Found no invite corresponding with the code {code} - replying...')
-        reply_and_delete_submission(subm)
+        logger.info('  Found no invite corresponding with the code %s - replying...', code)
+        reply_and_delete_submission(subm, comm)
         return
 
 
     guild_name = invite['guild']['name']
     guild_id = invite['guild']['id']
-    print_safe_name = make_printable(guild_name)
-    print(f'  Valid! Code {code} = {print_safe_name} (ID: {guild_id})')
-    if guild_id in blacklist.fetch():
-        print('  Server is blacklisted! Sending modmail...')
+    print_safe_name = log.printable(guild_name)
+    logger.info('  Valid! Code %s = %s (ID: %s)', code, print_safe_name, guild_id)
+    if guild_id in comm.blacklist.fetch():
+        logger.info('  Server is blacklisted! Sending modmail...')
+
+        if not can_act(subm, '    '):
+            return
 
         if config.dry_run:
-            print('  Would send modmail but this is a dry run; waiting 2 seconds instead')
+            logger.info('  Would send modmail but this is a dry run; waiting 2 seconds instead')
             time.sleep(2)
             return
 
-        msg = f'The user u/{subm.author.name if subm.author else None} tried making [this post]({subm.permalink}) for the banned server **{guild_name}** (Server ID: {guild_id}) in DiscordServers and was just caught by the bot.'
-        subreddit.modmail.create('Blacklisted server attempting to post!', msg, 'SubredditGuardian')
-        print('    Done sending, removing')
+        msg = f'The user u/{subm.author.name if subm.author else None} tried making [this post]({subm.permalink}) for the banned server **{guild_name}** (Server ID: {guild_id}) in {comm.name} and was just caught by the bot.'
+        comm.subreddit.modmail.create('Blacklisted server attempting to post!', msg, comm.modmail_recipient)
+        logger.info('    Done sending, removing')
         subm.mod.remove(spam=False)
-        print('    Done removing')
+        logger.info('    Done removing')
         return
 
     if 'PARTNERED' in invite['guild']['features']:
-        print(f'  Detected that the server has VIP features')
+        logger.info('  Detected that the server has VIP features')
         if (    subm.link_flair_text != 'Discord Partner'
              or subm.link_flair_css_class != 'partner-post'
         ):
-            if not config.dry_run:
-                subm.flair.select(config.flair_id)
-                print('    Flaired post as Discord Partner!')
-            else:
-                print('    Would have flaired as Discord Partner but this is a dry-run')
+            if config.dry_run:
+                logger.info('    Would have flaired as Discord Partner but this is a dry-run')
+            elif can_act(subm, '    '):
+                subm.flair.select(comm.flair_id)
+                logger.info('    Flaired post as Discord Partner!')
         else:
-            print('    Post already has flair.')
+            logger.info('    Post already has flair.')
 
     if not advert:
         _group = database.fetch_group_by_dgroup_id(guild_id)
         if _group is not None:
-            old_adverts = database.fetch_adverts_by_group_id(_group['id'])
+            old_adverts = database.fetch_adverts_by_group_id(_group['id'], comm.namespace)
 
             for old_advert in old_adverts:
                 assert(old_advert['fullname'] != subm.fullname)
                 time_since = subm.created_utc - old_advert['posted_at']
-                if time_since > 0 and time_since < config.min_time_between_posts_seconds:
+                if time_since > 0 and time_since < comm.min_time_between_posts_seconds:
                     old_permalink = old_advert['permalink']
-                    print(f'  Detected that the post was too soon after the last post')
-                    print(f'    Old permalink: {old_permalink}')
-                    print(f'    Time since: {str(timedelta(seconds=time_since))}')
-                    print('  Replying and deleting...')
-                    reply_and_delete_submission(subm, msg = config.too_soon_response_message.format(perma_link_new = subm.permalink, perma_link_old = old_permalink, time_left = str(timedelta(seconds=(config.min_time_between_posts_seconds - time_since)))))
+                    logger.info('  Detected that the post was too soon after the last post')
+                    logger.info('    Old permalink: %s', old_permalink)
+                    logger.info('    Time since: %s', timedelta(seconds=time_since))
+                    logger.info('  Replying and deleting...')
+                    reply_and_delete_submission(subm, comm, msg = comm.too_soon_response_message.format(perma_link_new = subm.permalink, perma_link_old = old_permalink, time_left = str(timedelta(seconds=(comm.min_time_between_posts_seconds - time_since)))))
                     return
 
     if advert:
         assert(group is not None)
-        old_print_safe_name = make_printable(group['dgroup_name'])
+        old_print_safe_name = log.printable(group['dgroup_name'])
         old_guild_id = group['dgroup_id']
 
         if guild_id != old_guild_id:
-            print(f'  Detected that this advert changed from {old_print_safe_name} to {print_safe_name}')
-            print('  This shouldn\'t happen, sending modmail and deleting')
+            logger.info('  Detected that this advert changed from %s to %s', old_print_safe_name, print_safe_name)
+            logger.info('  This shouldn\'t happen, sending modmail and deleting')
+
+            if not can_act(subm, '    '):
+                return
 
             if config.dry_run:
-                print('    This is a dry-run so waiting 2 seconds instead')
+                logger.info('    This is a dry-run so waiting 2 seconds instead')
                 time.sleep(2)
                 return
 
             msg = f'The user u/{subm.author.name if subm.author else None} made [this post](reddit.com{subm.permalink}) which changed from a link to {old_print_safe_name} (Server ID = {old_guild_id}) to {print_safe_name} (Server ID = {guild_id}). This is peculiar. I will delete it with no comment'
-            subreddit.modmail.create('Server link changed servers', msg, 'SubredditGuardian')
-            print('    Done sending, removing')
+            comm.subreddit.modmail.create('Server link changed servers', msg, comm.modmail_recipient)
+            logger.info('    Done sending, removing')
             subm.mod.remove(spam=False)
-            print('    Done removing')
+            logger.info('    Done removing')
             return
         
-        saved_adverts = database.fetch_adverts_by_group_id(group['id'])
+        saved_adverts = database.fetch_adverts_by_group_id(group['id'], comm.namespace)
 
         for saved_advert in saved_adverts:
             time_since = saved_advert['posted_at'] - subm.created_utc
-            if time_since > 0 and time_since < config.min_time_between_posts_seconds:
+            if time_since > 0 and time_since < comm.min_time_between_posts_seconds:
                     
                 saved_permalink = saved_advert['permalink']
                 
@@ -332,29 +466,42 @@ def handle_submission(subm):
                 newer_subm = saved_advert['fullname']
                 if newer_subm.startswith("t3_"):
                     newer_subm = newer_subm[3:]
+
+                if worker is not None and not worker.owns(newer_subm):
+                    logger.info('  Detected that this server was double-posted, but %s is in another worker\'s partition', newer_subm)
+                    return
+
+                if worker is not None and not worker.claim(newer_subm):
+                    logger.info('  Detected that this server was double-posted, but another worker is handling %s', newer_subm)
+                    return
                 
                 try:
                     saved_subm = reddit.submission(id=newer_subm);
-                    print(f'  Detected that this server was double-posted')
-                    print(f'    Previous saved permalink: {saved_permalink}')
-                    print(f'    Time since: {str(timedelta(seconds=time_since))}')
-                    print('  Replying and deleting...')
-                    reply_and_delete_submission(saved_subm, msg = config.double_post_response_message.format(perma_link_current = subm.permalink, perma_link_saved = saved_permalink, time_left = str(timedelta(seconds=(config.min_time_between_posts_seconds - time_since)))))
+                    logger.info('  Detected that this server was double-posted')
+                    logger.info('    Previous saved permalink: %s', saved_permalink)
+                    logger.info('    Time since: %s', timedelta(seconds=time_since))
+                    logger.info('  Replying and deleting...')
+                    if not reply_and_delete_submission(saved_subm, comm, msg = comm.double_post_response_message.format(perma_link_current = subm.permalink, perma_link_saved = saved_permalink, time_left = str(timedelta(seconds=(comm.min_time_between_posts_seconds - time_since))))):
+                        logger.info('  Keeping the database record, the newer post was not removed')
+                        return
                     # Remove the newer record
                     if config.dry_run:
-                        print(f'  Would remove database record, but dry-run is set. Waiting 2 seconds instead')
+                        logger.info('  Would remove database record, but dry-run is set. Waiting 2 seconds instead')
                         time.sleep(2)
                         return
                     database.delete_advert(saved_advert['id'])
-                    print(f"  Deleted double-post...")
+                    logger.info("  Deleted double-post...")
                     return
-                except Exception as DoublePostException:
-                    print(f'Error encountered while handling double-post:\r\n{DoublePostException}\r\n')
-                    pass
+                except Exception:
+                    logger.exception('Error encountered while handling double-post')
+                finally:
+                    if worker is not None:
+                        worker.release(newer_subm)
                 return
             
 
-        database.touch_advert(advert['id'])
+        # nothing reads updated_at again this loop, so don't wait for the commit
+        database.touch_advert(advert['id'], wait=False)
     else:
         assert(group is None)
 
@@ -364,63 +511,293 @@ def handle_submission(subm):
             group = database.fetch_group_by_dgroup_id(guild_id)
 
         assert(group is not None)
-        database.save_advert(subm.fullname, subm.permalink, group['id'], subm.created_utc)
+        database.save_advert(subm.fullname, subm.permalink, group['id'], subm.created_utc, link=subm.url, namespace=comm.namespace)
+
+def prefetch(listing):
+    """Resolves the redirects and invites the listing needs from one event loop.
 
+    The results are shared with handle_submission through invite_flight and
+    redirect_flight, so handling the posts afterwards only waits on reddit.
+    Posts that handle_submission would skip before looking anything up are
+    left out, and anything that fails here is retried by handle_submission
+    as usual.
 
-print('Connecting to database')
+    Args:
+        listing: A list of (community, submission, classification) tuples
+    """
+    redirect_urls = set()
+    codes = set()
+    for comm, subm, (kind, code) in listing:
+        if kind is None or subm.is_self or subm.banned_by is not None:
+            continue
+        advert = database.fetch_advert_by_fullname(subm.fullname)
+        if advert is not None and time.time() - advert['updated_at'] < comm.post_update_time_seconds:
+            continue
+        if kind == links.REDIRECT:
+            redirect_urls.add(subm.url)
+        elif code is not None:
+            codes.add(code)
+
+    if not redirect_urls and not codes:
+        return
+
+    started_at = time.time()
+    try:
+        redirect_results, invite_results = aioresolve.run(redirect_urls, codes, discord_bucket, config.async_concurrency, 1)
+    except Exception:
+        logger.exception('Prefetch failed; looking the listing up one post at a time')
+        return
+    for url, (resolved, final_url) in redirect_results.items():
+        if resolved:
+            redirect_flight.put(url, final_url)
+    for code, (resolved, invite) in invite_results.items():
+        if resolved:
+            invite_flight.put(code, invite)
+    logger.info('Prefetched %s redirects and %s invites in %.1f seconds', len(redirect_results), len(invite_results), time.time() - started_at)
+    logger.debug('Concurrency limits: %s', concurrency.limits())
+
+def handle_pending():
+    """Handles the submissions that were queued for us, ie by an audit."""
+    pending = database.fetch_pending()
+    if not pending:
+        return
+
+    if worker is not None:
+        pending = [row for row in pending if worker.owns(row['fullname'][3:])]
+        if not pending:
+            return
+
+    logger.info('======= Handling %s queued submissions... =======', len(pending))
+    for submission in reddit.info(fullnames=[row['fullname'] for row in pending]):
+        comm = communities_by_name.get(submission.subreddit.display_name.lower())
+        if comm is None:
+            logger.info('Ignoring queued submission %s; we do not moderate r/%s', submission.id, submission.subreddit.display_name)
+            continue
+        handle_claimed(submission, comm)
+        database.delete_pending(submission.fullname)
+        pacer.wait(config.check_min_sleep_seconds, config.check_sleep_time_seconds)
+
+    # Anything left was deleted from reddit
+    for row in pending:
+        database.delete_pending(row['fullname'])
+
+
+logger.info('Connecting to database')
 database.connect(config.database_file)
 database.create_missing_tables()
 database.prune()
 
-print('Fetching lists')
-blacklist = StringList('blacklist.txt')
-whitelist = StringList('whitelist.txt')
+if args.worker:
+    worker = workers.Worker(args.worker)
+    worker.refresh()
+    # The supervisor stops us with SIGTERM; exit cleanly so our leases are released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+watchdog.start()
 
-print('Logging in')
+logger.info('Logging in')
 reddit = praw.Reddit(client_id=auth_config.client_id,
                      client_secret=auth_config.client_secret,
                      password=auth_config.password,
                      user_agent='DiscordServers bot by /u/tjstretchalot',
                      username=auth_config.username)
 
-subreddit = reddit.subreddit(config.subreddit_name)
-recently_checked_subm_ids = []
-hot_check_counter = 0
-last_prune_time = time.time()
+logger.info('Fetching lists')
+communities = community.load(reddit)
+communities_by_name = dict((comm.name.lower(), comm) for comm in communities)
+pacer = Pacer(lambda: reddit.auth.limits,
+    reserve=config.pacing_reserve_requests + config.reddit_reserve_requests.get(consumer, 0))
+
+logger.info('Restoring checkpoint')
+# Each worker keeps its own checkpoint
+state_prefix = f'{args.worker}:' if args.worker else ''
+checkpoint_state = dict((key[len(state_prefix):], value)
+    for key, value in database.fetch_state().items() if key.startswith(state_prefix))
+if 'communities' in checkpoint_state:
+    for comm in communities:
+        comm.restore_state(checkpoint_state['communities'].get(comm.name, {}))
+        comm.feed.restore_state(checkpoint_state.get('feeds', {}).get(comm.name, {}))
+elif not args.worker:
+    # Saved before we moderated more than one subreddit
+    communities[0].restore_state(checkpoint_state)
+last_prune_time = checkpoint_state.get('last_prune_time', time.time())
+pacer.cost = checkpoint_state.get('pacer_cost')
+invite_flight.restore(checkpoint_state.get('invite_cache', []))
+redirect_flight.restore(checkpoint_state.get('redirect_cache', []))
+del checkpoint_state
+
+def checkpoint(caches=False, wait=True):
+    """Saves the scan state, so that a restart picks up where we left off.
+
+    Args:
+        caches: True to also save the invite and redirect lookups we are
+            still sharing and the mod feeds. These are larger, so they are
+            only saved between listings.
+        wait: False to queue the write instead of waiting for the commit,
+            as is done after every submission
+    """
+    state = {
+        'communities': dict((comm.name, comm.save_state()) for comm in communities),
+        'last_prune_time': last_prune_time,
+        'pacer_cost': pacer.cost,
+    }
+    if caches:
+        state['invite_cache'] = invite_flight.snapshot()
+        state['redirect_cache'] = redirect_flight.snapshot()
+        state['feeds'] = dict((comm.name, comm.feed.save_state()) for comm in communities)
+    database.save_state(dict((state_prefix + key, value) for key, value in state.items()), wait)
+
+def classify_listing(comm, submissions, skip_ids):
+    """Classifies the submissions of one community's listing.
+
+    Args:
+        comm: The community.Community the listing is from
+        submissions: A list of praw.models.reddit.Submission
+        skip_ids: Collection of submission ids to leave out
+
+    Submissions a moderator already removed or approved are left out too.
+
+    Returns:
+        A list of (community, submission, classification) tuples
+    """
+    res = []
+    resolved = 0
+    for submission, classification in zip(submissions, links.classify_many(subm.url for subm in submissions)):
+        if submission.id in skip_ids or (worker is not None and not worker.owns(submission.id)):
+            continue
+        if config.modfeed_enabled and comm.feed.is_resolved(submission):
+            resolved += 1
+            continue
+        res.append((comm, submission, classification))
+    if resolved:
+        logger.info('Leaving out %s submissions in r/%s that a moderator already handled', resolved, comm.name)
+    return res
+
+def scan_new():
+    """Handles the newest submissions in every community we have not handled yet."""
+    listings = []
+    seen_ids = {}
+    for comm in communities:
+        submissions = list(comm.subreddit.new(limit=comm.max_posts_until_miss_in_new))
+        seen_ids[comm.name] = [submission.id for submission in submissions]
+        listings.append(classify_listing(comm, submissions, set(comm.recently_checked_subm_ids)))
+
+    logger.info('======= Scanning new... (%s submissions) =======', sum(len(listing) for listing in listings))
+    listing = list(community.interleave(listings))
+    if config.async_prefetch:
+        prefetch(listing)
+    for comm, submission, classification in listing:
+        handle_claimed(submission, comm, classification)
+        comm.recently_checked_subm_ids.append(submission.id)
+        checkpoint(wait=False)
+        pacer.wait(config.check_min_sleep_seconds, config.check_sleep_time_seconds)
+
+    for comm in communities:
+        comm.recently_checked_subm_ids = seen_ids[comm.name]
+    checkpoint(caches=True)
+
+def scan_reported():
+    """Rechecks the submissions reported since we last checked them.
+
+    Reading the mod feeds also records which submissions the moderators
+    resolved, for classify_listing to leave out.
+    """
+    listings = []
+    for comm in communities:
+        reported = comm.feed.poll(config.modfeed_log_limit, config.modfeed_unmoderated_limit, config.modfeed_resolved_ttl_seconds)
+        listings.append(classify_listing(comm, reported, ()))
+    if not any(listings):
+        return
+
+    logger.info('======= Rechecking reported... (%s submissions) =======', sum(len(listing) for listing in listings))
+    for comm, submission, (kind, code) in community.interleave(listings):
+        logger.info('Submission %s has %s reports', submission.id, submission.num_reports)
+        # Look the post up again, even if we checked it recently
+        database.expire_advert(database.id_from_fullname(submission.fullname))
+        if kind == links.REDIRECT:
+            redirect_flight.forget(submission.url)
+        elif code is not None:
+            invite_flight.forget(code)
+        handle_claimed(submission, comm, (kind, code))
+        comm.feed.mark_checked(submission)
+        checkpoint(wait=False)
+        pacer.wait(config.check_min_sleep_seconds, config.check_sleep_time_seconds)
+
+    checkpoint(caches=True)
+
+def scan_hot(due):
+    """Rechecks the hot submissions of the given communities.
+
+    Each community's hot_done_ids is None between scans. While a scan is
+    running it is the list of submission ids the scan has handled, so that
+    a scan interrupted by a restart resumes rather than starting over.
+
+    Args:
+        due: The list of community.Community to scan
+    """
+    listings = []
+    for comm in due:
+        if comm.hot_done_ids is None:
+            comm.hot_done_ids = []
+        submissions = list(comm.subreddit.hot(limit=comm.num_hot_posts_to_rescan))
+        listings.append(classify_listing(comm, submissions, set(comm.hot_done_ids)))
+
+    logger.info('============== Scanning hot... (%s) ==============', ", ".join(comm.name for comm in due))
+    listing = list(community.interleave(listings))
+    if config.async_prefetch:
+        prefetch(listing)
+    for comm, submission, classification in listing:
+        handle_claimed(submission, comm, classification)
+        comm.hot_done_ids.append(submission.id)
+        checkpoint(wait=False)
+        pacer.wait(config.check_min_sleep_seconds, config.check_sleep_time_seconds)
+
+    for comm in due:
+        comm.hot_done_ids = None
+    checkpoint(caches=True)
 
 # CHECK SUBREDDIT FLAIRS BEFORE STARTING
-#for template in subreddit.flair.link_templates:
+#for template in communities[0].subreddit.flair.link_templates:
 #    print(template)
 
-while True:
-    print('======= Scanning new... =======')
-    just_checked = []
-    for submission in subreddit.new(limit=config.max_posts_until_miss_in_new):
-        just_checked.append(submission.id)
-        if submission.id in recently_checked_subm_ids:
-            continue
-        handle_submission(submission)
-        print(f'Sleeping for {config.check_sleep_time_seconds} seconds')
-        time.sleep(config.check_sleep_time_seconds)
-
-    recently_checked_subm_ids = just_checked
-    print(f'Sleeping for {config.loop_sleep_time_seconds} seconds')
-    time.sleep(config.loop_sleep_time_seconds)
-
-    if hot_check_counter <= 0:
-        hot_check_counter = config.loops_per_hot_check
-
-        print('============== Scanning hot... ==============')
-        for submission in subreddit.hot(limit=config.num_hot_posts_to_rescan):
-            handle_submission(submission)
-            print(f'Sleeping for {config.check_sleep_time_seconds} seconds')
-            time.sleep(config.check_sleep_time_seconds)
-        print(f'Sleeping for {config.loop_sleep_time_seconds} seconds')
-        time.sleep(config.loop_sleep_time_seconds)
-    else:
-        hot_check_counter -= 1
+try:
+    resuming = [comm for comm in communities if comm.hot_done_ids is not None]
+    if resuming:
+        logger.info('Resuming the hot scan, %s submissions were already handled', sum(len(comm.hot_done_ids) for comm in resuming))
+        scan_hot(resuming)
+
+    while True:
+        watchdog.beat()
+        if worker is not None:
+            worker.maybe_refresh()
+        invite_flight.prune()
+        redirect_flight.prune()
+
+        scan_new()
+        if config.modfeed_enabled:
+            scan_reported()
+        handle_pending()
+        pacer.wait(config.loop_min_sleep_seconds, config.loop_sleep_time_seconds)
+
+        due = []
+        for comm in communities:
+            if comm.hot_check_counter <= 0:
+                comm.hot_check_counter = comm.loops_per_hot_check
+                due.append(comm)
+            else:
+                comm.hot_check_counter -= 1
 
-    if last_prune_time + config.database_prune_period_seconds < time.time():
-        print('Pruning database')
-        database.prune()
-        last_prune_time = time.time()
+        if due:
+            scan_hot(due)
+            pacer.wait(config.loop_min_sleep_seconds, config.loop_sleep_time_seconds)
+        else:
+            checkpoint()
+
+        if last_prune_time + config.database_prune_period_seconds < time.time():
+            logger.info('Pruning database')
+            database.prune()
+            last_prune_time = time.time()
+            checkpoint()
+finally:
+    if worker is not None:
+        worker.stop()
@@ -0,0 +1,109 @@
+"""Classifies submission urls and extracts discord invite codes.
+
+A url is either an official discord link, a link to a redirector we trust
+to lead to discord, or unrecognized. The hosts for each are configured in
+config.py; the classifier compiles them into a single regular expression so
+that each url is parsed exactly once.
+"""
+
+import re
+
+import config
+
+OFFICIAL = 'official'
+"""Kind for a link that points directly at discord"""
+
+REDIRECT = 'redirect'
+"""Kind for a link to a whitelisted redirector"""
+
+_code_pattern = re.compile(r'[A-Za-z0-9-]+')
+
+class Classifier:
+    """Classifies urls against a registry of official and redirector hosts.
+
+    Attributes:
+        official_hosts: dict of lowercase host to a tuple of the lowercase
+            path prefixes that may come before the invite code on that host,
+            longest first
+        redirector_hosts: set of lowercase redirector hosts
+        pattern: the compiled regular expression for both sets of hosts
+    """
+
+    def __init__(self, official_hosts, redirector_hosts):
+        """Compiles the classifier for the given hosts.
+
+        Args:
+            official_hosts: dict of host to a list of invite path prefixes,
+                ie {'discord.gg': ['', 'invite/']}
+            redirector_hosts: iterable of redirector hosts
+        """
+        self.official_hosts = dict((host.lower(), tuple(sorted((prefix.lower() for prefix in prefixes), key=len, reverse=True)))
+            for host, prefixes in official_hosts.items())
+        self.redirector_hosts = set(host.lower() for host in redirector_hosts)
+
+        def alternation(hosts):
+            # Longest first so that no host shadows a longer one sharing its prefix
+            return '|'.join(re.escape(host) for host in sorted(hosts, key=len, reverse=True)) or '(?!)'
+
+        self.pattern = re.compile(
+            r'^\s*(?:https?://)?(?:[a-z0-9-]+\.)*?'
+            rf'(?:(?P<official>{alternation(self.official_hosts)})|(?P<redirect>{alternation(self.redirector_hosts)}))'
+            r'\.?(?::\d+)?(?P<path>/[^?#\s]*)?(?:[?#]\S*)?\s*$',
+            re.IGNORECASE)
+
+    def classify(self, url):
+        """Classifies the url and extracts the invite code if it has one.
+
+        Args:
+            url: A string url
+
+        Returns:
+            A tuple (kind, code). kind is OFFICIAL, REDIRECT or None if the
+            url is not recognized. code is the string invite code for
+            official invite links and None in all other cases.
+        """
+        if not url:
+            return None, None
+
+        match = self.pattern.match(url)
+        if match is None:
+            return None, None
+
+        if match.group('redirect') is not None:
+            return REDIRECT, None
+
+        path = (match.group('path') or '/')[1:]
+        if path.endswith('/'):
+            path = path[:-1]
+
+        for prefix in self.official_hosts[match.group('official').lower()]:
+            if not path.lower().startswith(prefix):
+                continue
+            code = path[len(prefix):]
+            if _code_pattern.fullmatch(code):
+                return OFFICIAL, code
+
+        return OFFICIAL, None
+
+    def classify_many(self, urls):
+        """Classifies each of the given urls.
+
+        Args:
+            urls: An iterable of string urls
+
+        Returns:
+            A list of (kind, code) tuples in the same order as urls
+        """
+        classify = self.classify
+        return [classify(url) for url in urls]
+
+classifier = Classifier(config.official_hosts, config.redirector_hosts)
+"""The classifier for the hosts in config"""
+
+def classify(url):
+    """Classifies the url using the hosts in config. See Classifier.classify"""
+    return classifier.classify(url)
+
+def classify_many(urls):
+    """Classifies the urls using the hosts in config. See Classifier.classify_many"""
+    return classifier.classify_many(urls)
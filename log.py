@@ -0,0 +1,127 @@
+"""Logging for the bot and its scripts.
+
+setup() sends every log record through a queue to a background thread,
+which writes it to stdout or to a rotating file, as text or as one json
+object per line. The scan loop only formats the message and puts it on the
+queue, so a slow stdout (ie a journald pipe) never holds it up.
+
+Log with %-style arguments, ie logger.info('Handling %s', subm.id), so that
+messages below the configured level are never formatted.
+"""
+
+import atexit
+import contextlib
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import string
+import sys
+import threading
+
+import config
+
+TEXT_FORMAT = '%(asctime)s %(levelname)-7s %(message)s'
+"""The format of the lines written when log_format is text"""
+
+_UNPRINTABLE = re.compile('[^' + re.escape(string.printable) + ']+')
+
+def printable(value):
+    """Removes the characters that are not in string.printable
+
+    Args:
+        value: The string to make printable, ie a discord server name
+
+    Returns:
+        The string with all weird characters filtered
+    """
+    return _UNPRINTABLE.sub('', value)
+
+_context = threading.local()
+
+@contextlib.contextmanager
+def context(**fields):
+    """Adds the fields to every record this thread logs inside the with block.
+
+    The json format writes them as keys of their own, so the lines about
+    one submission can be picked out, ie with context(submission=subm.id).
+    """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+class _ContextFilter(logging.Filter):
+    """Attaches the fields of the logging thread's context to each record"""
+
+    def filter(self, record):
+        record.context = getattr(_context, 'fields', {})
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one line of json"""
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        # The queue handler has already merged any traceback into the message
+        entry.update(getattr(record, 'context', {}))
+        return json.dumps(entry)
+
+_listener = None
+
+def setup(level=None, format=None, file=None):
+    """Sends the log records to the background writer. Call once, at startup.
+
+    Args:
+        level: The lowest level name to log, ie INFO. Defaults to
+            config.log_level
+        format: 'text' or 'json'. Defaults to config.log_format
+        file: The path of the file to log to, rotated at
+            config.log_max_bytes. Defaults to config.log_file, and when that
+            is None to stdout.
+    """
+    global _listener
+
+    if _listener is not None:
+        return
+
+    level = level or config.log_level
+    format = format or config.log_format
+    file = file or config.log_file
+
+    if file is not None:
+        handler = logging.handlers.RotatingFileHandler(file, maxBytes=config.log_max_bytes,
+            backupCount=config.log_backup_count, encoding='utf-8')
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    # Unbounded, so that logging never blocks the caller
+    records = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    atexit.register(stop)
+
+def stop():
+    """Writes the records still queued and stops the background writer"""
+    global _listener
+
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
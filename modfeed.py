@@ -0,0 +1,119 @@
+"""Follows what the moderators do, to narrow down the rescans.
+
+The mod log tells us which submissions a moderator has already removed or
+approved; those need nothing more from us, so the scans leave them out
+before doing any invite or redirect lookups. The unmoderated queue tells us
+which submissions were reported, so that they are rechecked first.
+"""
+
+import time
+
+REMOVE_ACTIONS = ('removelink', 'spamlink')
+"""The mod log actions that remove a submission"""
+
+APPROVE_ACTION = 'approvelink'
+"""The mod log action that approves a submission"""
+
+def _human_approver(name):
+    return name is not None and name != 'AutoModerator'
+
+class ModFeed:
+    """Tails one subreddit's mod log and unmoderated queue.
+
+    Attributes:
+        subreddit: The praw.models.Subreddit
+        resolved: dict of submission id to the unix time a moderator removed
+            or approved it
+        log_seen_until: The created_utc of the newest mod log entry read
+        reports: dict of submission id to how many reports it had when we
+            last checked it
+    """
+
+    def __init__(self, subreddit):
+        """Creates a feed that has read nothing yet.
+
+        Args:
+            subreddit: The praw.models.Subreddit to follow
+        """
+        self.subreddit = subreddit
+        self.resolved = {}
+        self.log_seen_until = 0
+        self.reports = {}
+
+    def is_resolved(self, subm):
+        """Checks if a moderator already removed or approved the submission.
+
+        Args:
+            subm: The praw.models.reddit.Submission
+
+        Returns:
+            True if the submission needs nothing more from us
+        """
+        if subm.id in self.resolved:
+            return True
+        return subm.banned_by is not None or _human_approver(subm.approved_by)
+
+    def poll(self, log_limit, unmoderated_limit, resolved_ttl):
+        """Reads the mod log entries since the last poll and the unmoderated queue.
+
+        Args:
+            log_limit: The most mod log entries to read
+            unmoderated_limit: The most unmoderated submissions to read
+            resolved_ttl: How many seconds a submission stays resolved
+
+        Returns:
+            A list of the praw.models.reddit.Submission in the unmoderated
+            queue that were reported since we last checked them
+        """
+        newest = self.log_seen_until
+        for action in self.subreddit.mod.log(limit=log_limit):
+            if action.created_utc <= self.log_seen_until:
+                break
+            newest = max(newest, action.created_utc)
+            if not action.target_fullname or not action.target_fullname.startswith('t3_'):
+                continue
+            if action.action in REMOVE_ACTIONS or (action.action == APPROVE_ACTION and _human_approver(str(action.mod))):
+                self.resolved[action.target_fullname[3:]] = action.created_utc
+        self.log_seen_until = newest
+
+        reported = []
+        reports = {}
+        for subm in self.subreddit.mod.unmoderated(limit=unmoderated_limit):
+            if not subm.fullname.startswith('t3_'):
+                continue
+            # No moderator has acted on it, whatever we saw before
+            self.resolved.pop(subm.id, None)
+            reports[subm.id] = self.reports.get(subm.id, 0)
+            if subm.num_reports and subm.num_reports > reports[subm.id]:
+                reported.append(subm)
+        self.reports = reports
+
+        cutoff = time.time() - resolved_ttl
+        self.resolved = dict((id, at) for id, at in self.resolved.items() if at >= cutoff)
+        return reported
+
+    def mark_checked(self, subm):
+        """Remembers that we rechecked the reported submission.
+
+        Args:
+            subm: The praw.models.reddit.Submission returned by poll
+        """
+        self.reports[subm.id] = subm.num_reports
+
+    def save_state(self):
+        """Returns the feed state as a json serializable dict"""
+        return {
+            'resolved': self.resolved,
+            'log_seen_until': self.log_seen_until,
+            'reports': self.reports,
+        }
+
+    def restore_state(self, state):
+        """Restores the feed state returned by save_state
+
+        Args:
+            state: The dict returned by save_state
+        """
+        self.resolved = state.get('resolved', {})
+        self.log_seen_until = state.get('log_seen_until', 0)
+        self.reports = state.get('reports', {})
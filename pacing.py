@@ -0,0 +1,123 @@
+"""Paces the bot to reddit's request budget.
+
+Reddit reports how many requests we have left in the current ratelimit
+window and when the window resets (praw exposes this as reddit.auth.limits).
+The Pacer spreads the remaining requests evenly over what is left of the
+window, so the bot moves quickly when there is headroom and slows down
+before it runs out.
+"""
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Pacer:
+    """Decides how long to wait between steps of the scan loop.
+
+    Attributes:
+        limits: Function returning a dict with the keys 'remaining', 'used'
+            and 'reset_timestamp', any of which may be None while unknown
+        reserve: Requests to leave unspent in every window
+        smoothing: Weight of the newest sample in the moving averages
+        cost: Moving average of requests used per step, None until measured
+        rate_per_second: Moving average of requests used per second, None
+            until measured
+        last_used: The 'used' value at the end of the last step
+        last_time: The time at the end of the last step
+    """
+
+    def __init__(self, limits, reserve=0, smoothing=0.2):
+        """Creates a pacer that has not measured anything yet.
+
+        Args:
+            limits: Function returning the current limits, ie
+                lambda: reddit.auth.limits
+            reserve: Requests to leave unspent in every window
+            smoothing: Weight of the newest sample in the moving averages
+        """
+        self.limits = limits
+        self.reserve = reserve
+        self.smoothing = smoothing
+        self.cost = None
+        self.rate_per_second = None
+        self.last_used = None
+        self.last_time = None
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old + self.smoothing * (new - old)
+
+    def observe(self):
+        """Measures the requests used since the last step."""
+        now = time.time()
+        used = self.limits().get('used')
+        if used is not None and self.last_used is not None:
+            # used restarts from 0 when the window resets
+            spent = used - self.last_used if used >= self.last_used else used
+            self.cost = self._average(self.cost, max(spent, 1))
+            if now > self.last_time:
+                self.rate_per_second = self._average(self.rate_per_second, spent / (now - self.last_time))
+        self.last_used = used
+        self.last_time = now
+
+    def delay(self, min_seconds, max_seconds):
+        """Calculates how long to wait before the next step.
+
+        Args:
+            min_seconds: The shortest wait, even with plenty of budget left
+            max_seconds: The longest wait while there is budget left. Also
+                used when the limits are unknown.
+
+        Returns:
+            The number of seconds to wait. This is longer than max_seconds
+            only when the budget is exhausted, in which case it is the time
+            until the window resets.
+        """
+        limits = self.limits()
+        remaining = limits.get('remaining')
+        reset_timestamp = limits.get('reset_timestamp')
+        if remaining is None or reset_timestamp is None:
+            return max_seconds
+
+        window_left = max(reset_timestamp - time.time(), 0)
+        budget = remaining - self.reserve
+        if budget <= 0:
+            return max(window_left, min_seconds)
+
+        cost = self.cost if self.cost is not None else 1
+        return min(max(cost * window_left / budget, min_seconds), max_seconds)
+
+    def wait(self, min_seconds, max_seconds):
+        """Measures the last step, then sleeps until the next one.
+
+        Args:
+            min_seconds: The shortest wait
+            max_seconds: The longest wait while there is budget left
+
+        Returns:
+            The number of seconds slept
+        """
+        self.observe()
+        seconds = self.delay(min_seconds, max_seconds)
+        logger.info('Sleeping for %.1f seconds (%s)', seconds, self.describe())
+        time.sleep(seconds)
+        return seconds
+
+    def describe(self):
+        """Describes the effective rate and remaining budget for logging.
+
+        Returns:
+            A short human readable string
+        """
+        limits = self.limits()
+        remaining = limits.get('remaining')
+        reset_timestamp = limits.get('reset_timestamp')
+        if remaining is None or reset_timestamp is None:
+            return 'limits unknown'
+
+        rate = f'{self.rate_per_second:.2f}' if self.rate_per_second is not None else '?'
+        cost = f'{self.cost:.1f}' if self.cost is not None else '?'
+        resets_in = max(round(reset_timestamp - time.time()), 0)
+        return f'{rate} req/s, {cost} req/step, {round(remaining)} remaining, resets in {resets_in}s'
@@ -0,0 +1,225 @@
+"""Rate limiting for requests to external services.
+
+TokenBucket limits the requests of one process. SharedTokenBucket shares
+one budget between every process on the host that opens the same file, so
+an audit or a dry run instance running next to the bot does not get the
+bot ratelimited.
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+
+class TokenBucket:
+    """A thread-safe token bucket.
+
+    Tokens refill continuously at the given rate up to the capacity. Each
+    request takes one token, waiting until one is available.
+
+    Attributes:
+        rate: The number of tokens added per second
+        capacity: The maximum number of tokens the bucket holds
+        tokens: The number of tokens available as of updated_at
+        updated_at: The monotonic time tokens was last brought up to date.
+            In the future while the bucket is penalized.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """Creates a full bucket.
+
+        Args:
+            rate: Tokens per second
+            capacity: Maximum burst size. Defaults to one second of tokens,
+                but never less than 1.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now <= self.updated_at:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _wait(self, now, tokens):
+        return max(self.updated_at - now, 0) + max(tokens - self.tokens, 0) / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Takes tokens if they are available right now.
+
+        Args:
+            tokens: The number of tokens to take
+
+        Returns:
+            0 if the tokens were taken, otherwise the number of seconds until
+            they would be available.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= tokens and now >= self.updated_at:
+                self.tokens -= tokens
+                return 0
+            return self._wait(now, tokens)
+
+    def penalize(self, seconds):
+        """Empties the bucket and stops it refilling for a while.
+
+        For when the service ratelimited us anyway.
+
+        Args:
+            seconds: How long to give out no tokens
+        """
+        with self.lock:
+            self.tokens = 0
+            self.updated_at = max(self.updated_at, time.monotonic() + seconds)
+
+    def acquire(self, tokens=1):
+        """Takes tokens, sleeping until they are available.
+
+        Args:
+            tokens: The number of tokens to take
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """Takes tokens, yielding to the event loop until they are available.
+
+        Args:
+            tokens: The number of tokens to take
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+class SharedTokenBucket(TokenBucket):
+    """A token bucket shared by every process that opens the same file.
+
+    The bucket is a row in a small sqlite database, read and updated in one
+    locked transaction per request. A request that gets no tokens rolls its
+    transaction back, so waiting consumers only read the file. Times are
+    unix times rather than monotonic, as they are compared between
+    processes.
+
+    Consumers that matter less leave a reserve of tokens in the bucket,
+    which only the consumers that matter more may take, so the scan always
+    gets its requests before background jobs do. Every consumer should use
+    the same rate and capacity for a bucket.
+
+    Attributes:
+        file: The path of the database shared between processes
+        name: The name of the bucket in that database, ie discord
+        reserve: The tokens this consumer leaves for others
+    """
+
+    def __init__(self, file, name, rate, capacity=None, reserve=0):
+        """Opens the shared bucket, creating it full if it does not exist.
+
+        Args:
+            file: The path of the database shared between processes
+            name: The name of the bucket, the same for every consumer
+            rate: Tokens per second
+            capacity: Maximum burst size, see TokenBucket
+            reserve: How many tokens to leave for consumers with less reserve.
+                At most capacity - 1.
+        """
+        super().__init__(rate, capacity)
+        self.file = file
+        self.name = name
+        self.reserve = min(reserve, self.capacity - 1)
+        self.connection = sqlite3.connect(file, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated_at REAL) WITHOUT ROWID')
+
+    def _update(self, fn):
+        """Runs fn(now) with tokens and updated_at loaded, then saves them.
+
+        fn returns a tuple (result, changed). When changed is False nothing
+        is written.
+
+        Returns:
+            The result fn returned
+        """
+        with self.lock:
+            cur = self.connection.cursor()
+            try:
+                cur.execute('BEGIN IMMEDIATE')
+                now = time.time()
+                cur.execute('SELECT tokens, updated_at FROM buckets WHERE name=?', (self.name,))
+                row = cur.fetchone()
+                self.tokens, self.updated_at = row if row is not None else (self.capacity, now)
+                self._refill(now)
+                result, changed = fn(now)
+                if changed:
+                    cur.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                        (self.name, self.tokens, self.updated_at))
+                    cur.execute('COMMIT')
+                else:
+                    cur.execute('ROLLBACK')
+            except:
+                if self.connection.in_transaction:
+                    cur.execute('ROLLBACK')
+                raise
+            finally:
+                cur.close()
+        return result
+
+    def try_acquire(self, tokens=1):
+        """Takes tokens if they are available right now, leaving the reserve.
+
+        Args:
+            tokens: The number of tokens to take
+
+        Returns:
+            0 if the tokens were taken, otherwise the number of seconds until
+            they would be available.
+        """
+        wanted = tokens + self.reserve
+        def take(now):
+            if self.tokens >= wanted and now >= self.updated_at:
+                self.tokens -= tokens
+                return 0, True
+            return self._wait(now, wanted), False
+        return self._update(take)
+
+    async def acquire_async(self, tokens=1):
+        """Takes tokens, yielding to the event loop until they are available.
+
+        The sqlite transaction can wait on other processes for a while, so
+        it runs in the loop's default executor rather than on the loop.
+
+        Args:
+            tokens: The number of tokens to take
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            wait = await loop.run_in_executor(None, self.try_acquire, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def penalize(self, seconds):
+        """Empties the bucket and stops it refilling for every process.
+
+        Args:
+            seconds: How long to give out no tokens
+        """
+        def block(now):
+            self.tokens = 0
+            self.updated_at = max(self.updated_at, now + seconds)
+            return None, True
+        self._update(block)
+
+    def close(self):
+        """Closes the connection to the shared file"""
+        self.connection.close()
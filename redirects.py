@@ -1,9 +1,28 @@
 """Manages following redirects."""
 
+import asyncio
+import logging
+import time
+
 import requests
 
 from bs4 import BeautifulSoup
 
+import concurrency
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_SECONDS = 10
+"""How long a single hop may take"""
+
+FOLLOW_TIMEOUT_SECONDS = 30
+"""How long following all the hops of a url may take by default"""
+
 redir_codes = [ 301, 302, 303, 307, 308 ]
 """Codes that indicate a simple http redirect"""
 
@@ -28,52 +47,68 @@ def find_redirect(response):
         A string of the url the response is redirecting to, or None if no
         redirect is found.
     """
+    return _find_redirect(response.url, response.status_code, response.headers, response.text)
+
+def _find_redirect(url, status_code, headers, text):
     global redir_codes
 
-    if response.status_code in redir_codes:
-        redir_url = response.headers['Location']
-        print(f'{response.url} uses {response.status_code} to redirect to {redir_url}')
+    if status_code in redir_codes:
+        redir_url = headers['Location']
+        logger.info('%s uses %s to redirect to %s', url, status_code, redir_url)
         return redir_url
 
-    soup = BeautifulSoup(response.text, 'html5lib')
+    soup = BeautifulSoup(text, 'html5lib')
 
     metas = soup.find_all('meta')
 
     for meta in metas:
         if ('property' in meta.attrs and meta.attrs['property'] == 'refresh') or ('http-equiv' in meta.attrs and meta.attrs['http-equiv'] == 'refresh'):
             content = meta.attrs['content']
-            url = content.split(';')[1][4:]
-            if url.startswith('='): # Fix more messy Django crap (Discord.st)
-                url = url[1:]
-            print(response.url, 'uses meta property ->', url)
-            return url
+            redir_url = content.split(';')[1][4:]
+            if redir_url.startswith('='): # Fix more messy Django crap (Discord.st)
+                redir_url = redir_url[1:]
+            logger.info('%s uses meta property -> %s', url, redir_url)
+            return redir_url
 
     return None
 
 
-def _follow(url, predicate, tries=1, max_redirects=5):
+def _hop_timeout(url, deadline):
+    """The timeout for the next hop, so that it ends by the deadline"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise RedirectError('Deadline exceeded', url)
+    return min(TIMEOUT_SECONDS, remaining)
+
+def _follow(url, predicate, deadline, tries=1, max_redirects=5):
     if tries > max_redirects:
         raise requests.exceptions.TooManyRedirects()
 
     response = None
-    try:
-        response = requests.get(url, allow_redirects=False, timeout=10)
-    except requests.exceptions.ConnectionError as ce:
-        raise RedirectError('Connection failure', url) from ce
-    except requests.exceptions.ReadTimeout as rte:
-        raise RedirectError('Read timeout', url) from rte
-    except requests.exceptions.RequestException as re:
-        raise RedirectError('Unusual HTTP error', url) from re
+    with concurrency.limiter_for(url).slot() as slot:
+        try:
+            response = requests.get(url, allow_redirects=False, timeout=_hop_timeout(url, deadline))
+        except requests.exceptions.ConnectionError as ce:
+            if isinstance(ce, requests.exceptions.Timeout):
+                slot.outcome = concurrency.OVERLOADED
+            raise RedirectError('Connection failure', url) from ce
+        except requests.exceptions.ReadTimeout as rte:
+            slot.outcome = concurrency.OVERLOADED
+            raise RedirectError('Read timeout', url) from rte
+        except requests.exceptions.RequestException as re:
+            raise RedirectError('Unusual HTTP error', url) from re
+        if response.status_code in (429, 503):
+            slot.outcome = concurrency.OVERLOADED
 
     redir_url = find_redirect(response)
     if redir_url:
         if not predicate(redir_url):
             return redir_url
-        return _follow(redir_url, predicate, tries + 1, max_redirects)
+        return _follow(redir_url, predicate, deadline, tries + 1, max_redirects)
 
     return url
 
-def follow(url, predicate, max_redirects=10):
+def follow(url, predicate, max_redirects=10, timeout=FOLLOW_TIMEOUT_SECONDS):
     """Follows redirects starting at the given url.
 
     Finishes either when the predicate returns False or when there are no
@@ -84,12 +119,74 @@ def follow(url, predicate, max_redirects=10):
         predicate: Function that accepts a url and returns a bool indicating
             if we should try to continue. True to continue, False to end.
         max_redirects: The maximum redirects to follow
+        timeout: The most seconds following every hop may take
+
+    Returns:
+        The string of the final url reached.
+
+    Raises:
+        RedirectError: If we cannot reach a URL along the way, or the
+            timeout passes first
+        TooManyRedirects: If it exceeds the maximum number of redirects
+    """
+    return _follow(url, predicate, time.monotonic() + timeout, max_redirects=max_redirects)
+
+async def _follow_async(url, predicate, session, deadline, tries=1, max_redirects=5):
+    if tries > max_redirects:
+        raise requests.exceptions.TooManyRedirects()
+
+    async with concurrency.limiter_for(url).slot_async() as slot:
+        try:
+            async with session.get(url, allow_redirects=False,
+                    timeout=aiohttp.ClientTimeout(total=_hop_timeout(url, deadline))) as response:
+                text = await response.text(errors='replace')
+                if response.status in (429, 503):
+                    slot.outcome = concurrency.OVERLOADED
+        except aiohttp.ClientConnectionError as ce:
+            raise RedirectError('Connection failure', url) from ce
+        except asyncio.TimeoutError as te:
+            slot.outcome = concurrency.OVERLOADED
+            raise RedirectError('Read timeout', url) from te
+        except aiohttp.ClientError as ce:
+            raise RedirectError('Unusual HTTP error', url) from ce
+    redir_url = _find_redirect(url, response.status, response.headers, text)
+
+    if redir_url:
+        if not predicate(redir_url):
+            return redir_url
+        return await _follow_async(redir_url, predicate, session, deadline, tries + 1, max_redirects)
+
+    return url
+
+async def follow_async(url, predicate, max_redirects=10, session=None, timeout=FOLLOW_TIMEOUT_SECONDS):
+    """Follows redirects starting at the given url, without blocking.
+
+    The same as follow, except that each hop is made with aiohttp. Cancelling
+    the calling task cancels the hop in flight.
+
+    Args:
+        url: The string url to follow
+        predicate: Function that accepts a url and returns a bool indicating
+            if we should try to continue. True to continue, False to end.
+        max_redirects: The maximum redirects to follow
+        session: The aiohttp.ClientSession to use. Defaults to a new session
+            just for this url; pass one in when following many urls.
+        timeout: The most seconds following every hop may take
 
     Returns:
         The string of the final url reached.
 
     Raises:
-        RedirectError: If we cannot reach a URL along the way
+        RedirectError: If we cannot reach a URL along the way, or the
+            timeout passes first
         TooManyRedirects: If it exceeds the maximum number of redirects
     """
-    return _follow(url, predicate, max_redirects=max_redirects)
+    if aiohttp is None:
+        raise ModuleNotFoundError('aiohttp is required for async requests')
+
+    deadline = time.monotonic() + timeout
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await _follow_async(url, predicate, session, deadline, max_redirects=max_redirects)
+
+    return await _follow_async(url, predicate, session, deadline, max_redirects=max_redirects)
@@ -1,29 +1,41 @@
 
 """Utility functions that don't belong in the other files."""
+import logging
 import time
-import traceback
+
+logger = logging.getLogger(__name__)
 
 class RetryError(Exception):
     pass
 
-def backoff(tries):
+def backoff_seconds(tries):
+    """
+    How long backoff waits after the given number of unsuccessful attempts.
+
+    Args:
+        tries: The number of unsuccessful attempts in a row
+    """
+    if tries < 30:
+        return tries * 60
+    return 30 * 60
+
+def backoff(tries, max_seconds=None):
     """
     Waits some duration of time in order to prevent server overloading when
     in high load.
 
     Args:
         tries: The number of unsuccessful attempts in a row
+        max_seconds: The longest to wait, or None for no limit
     """
-    sleep_time = None
-    if tries < 30:
-        sleep_time = tries * 60
-    else:
-        sleep_time = 30 * 60
+    sleep_time = backoff_seconds(tries)
+    if max_seconds is not None:
+        sleep_time = min(sleep_time, max_seconds)
 
-    print(f'Sleeping for {sleep_time} seconds')
+    logger.info('Sleeping for %s seconds', round(sleep_time))
     time.sleep(sleep_time)
 
-def until_success(doer, args=None, kwargs=None, failure_fn=backoff, max_attempts=None):
+def until_success(doer, args=None, kwargs=None, failure_fn=backoff, max_attempts=None, timeout=None):
     """
     Repeats the doer until the first result is truthy.
 
@@ -39,12 +51,15 @@ def until_success(doer, args=None, kwargs=None, failure_fn=backoff, max_attempts
             unsuccessful attempts so far. Defaults to backing off.
         max_attempts: The maximum number of attempts to do before raising a
             RetryError. None for no limit. Defaults to no limit.
+        timeout: The most seconds to keep retrying for before raising a
+            RetryError. None for no limit. The default backoff never waits
+            past it; another failure function may.
 
     Returns:
         The second result of the tuple returned by doer.
 
     Raises:
-        RetryError: if this exceeds the maximum attempts.
+        RetryError: if this exceeds the maximum attempts or the timeout.
     """
 
     if args is None:
@@ -53,6 +68,7 @@ def until_success(doer, args=None, kwargs=None, failure_fn=backoff, max_attempts
     if kwargs is None:
         kwargs = {}
 
+    deadline = None if timeout is None else time.monotonic() + timeout
     tries = 0
     while max_attempts is None or tries < max_attempts:
         tries = tries + 1
@@ -60,11 +76,19 @@ def until_success(doer, args=None, kwargs=None, failure_fn=backoff, max_attempts
         try:
             success, result = doer(*args, **kwargs)
         except Exception:
-            traceback.print_exc()
+            logger.exception('Error while retrying')
 
         if success:
             return result
 
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RetryError(f'Gave up after {timeout} seconds')
+            if failure_fn is backoff:
+                backoff(tries, remaining)
+                continue
+
         failure_fn(tries, *args, **kwargs)
 
     raise RetryError(f'Number attempts exceeded max attempts={max_attempts}')
@@ -0,0 +1,161 @@
+"""Coalesces concurrent lookups for the same key.
+
+When a lookup for a key is already running, other callers wait for that
+lookup instead of starting their own. Finished results are kept for a short
+while so that lookups made one after another, as the serial scan loop does,
+are coalesced as well.
+"""
+
+import threading
+import time
+
+class _Call:
+    """One lookup, shared by everyone that asked for its key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.elapsed = None
+        self.finished_at = None
+
+class SingleFlight:
+    """Runs at most one lookup per key at a time. Thread-safe.
+
+    Attributes:
+        ttl: How many seconds a finished result is reused for. 0 to only
+            coalesce lookups that overlap.
+        calls: dict of key to the _Call running or remembered for it
+        timings: dict of key to the seconds its most recent lookup took
+    """
+
+    def __init__(self, ttl=0):
+        """Creates an empty single-flight group.
+
+        Args:
+            ttl: How many seconds a finished result is reused for
+        """
+        self.ttl = ttl
+        self.calls = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def _is_fresh(self, call, now):
+        return call.finished_at is None or now - call.finished_at < self.ttl
+
+    def do(self, key, fn, *args, **kwargs):
+        """Returns the result of fn(*args, **kwargs), sharing it for the key.
+
+        If fn raises, the error is raised to every caller waiting on the key
+        and nothing is remembered.
+
+        Args:
+            key: The hashable key identifying the lookup, ie an invite code
+            fn: The function that performs the lookup
+
+        Returns:
+            A tuple (result, elapsed, shared). result is what fn returned,
+            elapsed is how many seconds the lookup took and shared is True if
+            this caller reused a lookup started by someone else.
+        """
+        with self.lock:
+            now = time.monotonic()
+            call = self.calls.get(key)
+            if call is not None and self._is_fresh(call, now):
+                owner = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                owner = True
+
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, call.elapsed, True
+
+        started_at = time.monotonic()
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            call.elapsed = time.monotonic() - started_at
+            call.finished_at = time.monotonic()
+            with self.lock:
+                self.timings[key] = call.elapsed
+                if call.error is not None or self.ttl <= 0:
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+            call.done.set()
+
+        return call.result, call.elapsed, False
+
+    def put(self, key, result, elapsed=0, age=0):
+        """Remembers a result for the key that was looked up elsewhere.
+
+        Callers asking for the key within the ttl get this result instead of
+        starting a lookup. Does nothing if the ttl is 0 or a lookup for the
+        key is already running.
+
+        Args:
+            key: The hashable key identifying the lookup
+            result: The result of the lookup
+            elapsed: How many seconds the lookup took
+            age: How many seconds ago the lookup finished
+        """
+        if self.ttl <= 0:
+            return
+
+        call = _Call()
+        call.result = result
+        call.elapsed = elapsed
+        call.finished_at = time.monotonic() - age
+        call.done.set()
+        with self.lock:
+            existing = self.calls.get(key)
+            if existing is not None and existing.finished_at is None:
+                return
+            self.calls[key] = call
+            self.timings[key] = elapsed
+
+    def snapshot(self):
+        """Lists the finished results that are still fresh, for saving.
+
+        Returns:
+            A list of [key, result, elapsed, finished_at] lists, where
+            finished_at is in unix time.
+        """
+        with self.lock:
+            now = time.monotonic()
+            offset = time.time() - now
+            return [[key, call.result, call.elapsed, call.finished_at + offset]
+                for key, call in self.calls.items()
+                if call.finished_at is not None and call.error is None and self._is_fresh(call, now)]
+
+    def restore(self, entries):
+        """Remembers results saved by snapshot, unless they have gone stale.
+
+        Args:
+            entries: The list returned by snapshot
+        """
+        for key, result, elapsed, finished_at in entries:
+            age = max(time.time() - finished_at, 0)
+            if age < self.ttl:
+                self.put(key, result, elapsed, age)
+
+    def forget(self, key):
+        """Stops reusing the finished result for the key, if there is one."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call.finished_at is not None:
+                del self.calls[key]
+
+    def prune(self):
+        """Drops finished results older than the ttl, and their timings."""
+        with self.lock:
+            now = time.monotonic()
+            for key in [key for key, call in self.calls.items() if not self._is_fresh(call, now)]:
+                del self.calls[key]
+            self.timings = dict((key, elapsed) for key, elapsed in self.timings.items() if key in self.calls)
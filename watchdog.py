@@ -0,0 +1,131 @@
+"""Notices when the scan loop stops making progress.
+
+The scan loop calls beat as it makes progress, and wraps the handling of
+each submission in operation. A background thread checks on both: when there
+has been no heartbeat for stall_seconds, or one operation has run for longer
+than deadline_seconds, it logs the stack of every thread. An operation past
+its deadline is then interrupted: the watchdog signals the scan thread,
+which raises StallError from wherever it is stuck, even a blocking socket
+read, so the scan can skip the submission and carry on.
+
+Interrupting needs signal.pthread_kill and SIGUSR1, and the watchdog must be
+created by the main thread. Elsewhere it only logs.
+"""
+
+import contextlib
+import faulthandler
+import logging
+import signal
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+class StallError(BaseException):
+    """Raised in the scan thread when its operation ran past the deadline.
+
+    A BaseException, like KeyboardInterrupt, so that the except Exception
+    handlers along the way, such as the retries, do not swallow it.
+    """
+    pass
+
+class Watchdog(threading.Thread):
+    """The thread watching the thread that created it.
+
+    Attributes:
+        stall_seconds: How long without a heartbeat counts as stalled
+        deadline_seconds: How long one operation may run
+        beat_at: The monotonic time of the last heartbeat
+        current: The description of the running operation, None between
+            operations
+        started_at: The monotonic time the running operation started
+        thread_id: The ident of the watched thread
+        can_interrupt: True if stuck operations are interrupted, False if
+            they are only logged
+    """
+
+    def __init__(self, stall_seconds, deadline_seconds):
+        """Creates the watchdog for the calling thread. Call start to run it.
+
+        Args:
+            stall_seconds: How long without a heartbeat counts as stalled
+            deadline_seconds: How long one operation may run
+        """
+        super().__init__(name='watchdog', daemon=True)
+        self.stall_seconds = stall_seconds
+        self.deadline_seconds = deadline_seconds
+        self.check_seconds = max(min(stall_seconds, deadline_seconds) / 10, 1)
+        self.beat_at = time.monotonic()
+        self.current = None
+        self.started_at = None
+        self.reported = None
+        self.interrupt_for = None
+        self.thread_id = threading.get_ident()
+        self.can_interrupt = (threading.current_thread() is threading.main_thread()
+            and hasattr(signal, 'pthread_kill') and hasattr(signal, 'SIGUSR1'))
+        if self.can_interrupt:
+            signal.signal(signal.SIGUSR1, self._interrupted)
+        # A crash in C code dumps every thread's stack as well
+        faulthandler.enable()
+
+    def _interrupted(self, signum, frame):
+        # The operation may have finished since the watchdog decided to
+        # interrupt it; only interrupt the one it meant
+        if self.current is not None and self.started_at == self.interrupt_for:
+            self.interrupt_for = None
+            raise StallError(f'{self.current} ran for longer than {self.deadline_seconds} seconds')
+
+    def beat(self):
+        """Records that the watched thread made progress."""
+        self.beat_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def operation(self, description):
+        """Watches the with block as one operation with a deadline.
+
+        Args:
+            description: What the operation is, for the logs, ie handling
+                submission asdf
+
+        Raises:
+            StallError: If the block runs past the deadline
+        """
+        self.started_at = time.monotonic()
+        self.current = description
+        self.beat()
+        try:
+            yield
+        finally:
+            self.current = None
+            self.interrupt_for = None
+            self.beat()
+
+    def run(self):
+        while True:
+            time.sleep(self.check_seconds)
+            now = time.monotonic()
+            operation, started_at = self.current, self.started_at
+            if operation is not None and now - started_at > self.deadline_seconds:
+                if self.reported == started_at:
+                    continue
+                self.reported = started_at
+                self.dump_stacks(f'{operation} has run for {now - started_at:.0f} seconds')
+                if self.can_interrupt:
+                    self.interrupt_for = started_at
+                    signal.pthread_kill(self.thread_id, signal.SIGUSR1)
+            elif now - self.beat_at > self.stall_seconds and self.reported != self.beat_at:
+                self.reported = self.beat_at
+                self.dump_stacks(f'No progress for {now - self.beat_at:.0f} seconds')
+
+    def dump_stacks(self, reason):
+        """Logs the stack of every thread as an error.
+
+        Args:
+            reason: Why the stacks are being dumped
+        """
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        stacks = ''.join(f'\nThread {names.get(ident, ident)}:\n' + ''.join(traceback.format_stack(frame))
+            for ident, frame in sys._current_frames().items())
+        logger.error('%s; stack of every thread:%s', reason, stacks)
@@ -0,0 +1,130 @@
+"""Splits the scan between several worker processes.
+
+Submissions are partitioned by their id. Each worker holds leases on an
+equal share of the partitions and only handles submissions in those; when a
+worker stops renewing its leases, the others take over its partitions once
+they expire. Before handling a submission a worker also claims a lease on
+the submission itself, and it checks that it still holds both the lease and
+the submission's partition before every moderator action, so two workers
+never act on the same post. A worker whose partition moved while it was
+working through a listing skips the rest of that partition.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+class Worker:
+    """One worker process's view of the partitions it holds.
+
+    Attributes:
+        name: The name the worker was started with
+        owner: The string identifying this process in the leases table
+        partitions: The set of int partitions we hold
+        refreshed_at: Unix time we last renewed our leases
+    """
+
+    def __init__(self, name):
+        """Creates a worker that holds no partitions yet.
+
+        Args:
+            name: The name of the worker, ie worker-0
+        """
+        self.name = name
+        self.owner = f'{name}:{os.getpid()}'
+        self.partitions = set()
+        self.refreshed_at = 0
+
+    def refresh(self):
+        """Renews our leases and takes our share of the partitions."""
+        partitions = set(database.refresh_partitions(self.owner, config.worker_partitions, config.worker_lease_seconds))
+        if partitions != self.partitions:
+            logger.info('%s now holds %s of %s partitions', self.name, len(partitions), config.worker_partitions)
+        self.partitions = partitions
+        self.refreshed_at = time.time()
+
+    def maybe_refresh(self):
+        """Refreshes our leases if a third of the lease time has passed."""
+        if time.time() - self.refreshed_at > config.worker_lease_seconds / 3:
+            self.refresh()
+
+    def owns(self, subm_id):
+        """Checks if the submission is in one of our partitions.
+
+        Args:
+            subm_id: The reddit id of the submission, ie asdf
+
+        Returns:
+            True if this worker should handle the submission
+        """
+        self.maybe_refresh()
+        return database.id_from_fullname(subm_id) % config.worker_partitions in self.partitions
+
+    def claim(self, subm_id):
+        """Claims the submission so no other worker handles it meanwhile.
+
+        Args:
+            subm_id: The reddit id of the submission
+
+        Returns:
+            True if we hold the submission, False if another worker does
+        """
+        return database.claim_lease(f'submission:{subm_id}', self.owner, config.submission_lease_seconds)
+
+    def holds(self, subm_id):
+        """Checks that our claim on the submission has not lapsed.
+
+        Args:
+            subm_id: The reddit id of the submission
+
+        Returns:
+            True if we may still act on the submission
+        """
+        return database.holds_lease(f'submission:{subm_id}', self.owner)
+
+    def release(self, subm_id):
+        """Gives up our claim on the submission.
+
+        Args:
+            subm_id: The reddit id of the submission
+        """
+        database.release_lease(f'submission:{subm_id}', self.owner)
+
+    def stop(self):
+        """Gives up every lease, so the other workers take over right away."""
+        database.release_leases(self.owner)
+
+def supervise(count, script):
+    """Runs count workers of the script, restarting any that exit.
+
+    Returns when interrupted, after stopping the workers.
+
+    Args:
+        count: How many workers to run
+        script: The path of the script to run with --worker NAME
+    """
+    children = {}
+    try:
+        while True:
+            for index in range(count):
+                child = children.get(index)
+                if child is not None and child.poll() is None:
+                    continue
+                if child is not None:
+                    logger.info('worker-%s exited with %s, restarting', index, child.returncode)
+                children[index] = subprocess.Popen([sys.executable, script, '--worker', f'worker-{index}'])
+            time.sleep(5)
+    except KeyboardInterrupt:
+        logger.info('Stopping workers')
+    finally:
+        for child in children.values():
+            child.terminate()
+        for child in children.values():
+            child.wait()